@@ -0,0 +1,91 @@
+import functools
+import warnings
+
+import numpy as np
+
+BACKENDS = ["numpy", "numba"]
+
+
+def get_backend(name="numpy"):
+    """kernels of the inner loops of the computation as a dict
+
+    The numba backend compiles the loops over the windows, samples and days
+    instead of vectorizing them, which avoids the temporary arrays of the
+    numpy kernels. If numba is not installed, the numpy kernels are returned
+    with a warning.
+    """
+
+    if name == "numpy":
+        return NUMPY_KERNELS
+    elif name == "numba":
+        kernels = _numba_kernels()
+        if kernels is None:
+            warnings.warn("numba is not installed, using the numpy backend")
+            return NUMPY_KERNELS
+        return kernels
+    else:
+        raise ValueError("unknown backend")
+
+
+def resolve_backend(name):
+    """name of the backend that get_backend actually uses"""
+
+    if name not in BACKENDS:
+        raise ValueError("unknown backend")
+    if name == "numba" and _numba_kernels() is None:
+        warnings.warn("numba is not installed, using the numpy backend")
+        return "numpy"
+    return name
+
+
+def window_exceedances(samples, means, test_statistic):
+    """number of samples per window whose test statistic is at least the
+    observed one; samples is overwritten"""
+
+    samples -= means[:, np.newaxis, :]
+    test_statistic_samples = np.sum(np.square(samples, out=samples), axis=2)
+    return np.sum(test_statistic_samples >= test_statistic[:, np.newaxis], axis=1)
+
+
+def solve_windows(A, b):
+    """minimum norm least squares solutions of a stack of linear systems"""
+
+    return np.matmul(np.linalg.pinv(A), b[:, :, np.newaxis])[:, :, 0]
+
+
+def level_set_lines(pvals, kappas, p0s):
+    """first kappa per day whose p-value exceeds p0, 0 if there is none"""
+
+    kappa_level = np.zeros((len(p0s), pvals.shape[1]))
+    if pvals.shape[0] == 0:
+        return kappa_level
+
+    # the running maximum over the kappas exceeds p0 from the first exceedance
+    # on, so the index of the first exceedance is the number of rows where it
+    # does not; fmax skips the nan rows
+    running_max = np.fmax.accumulate(pvals, axis=0)
+    for k, p0 in enumerate(p0s):
+        idx_first = np.sum(~(running_max > p0), axis=0)
+        found = idx_first < pvals.shape[0]
+        kappa_level[k, found] = kappas[idx_first[found]]
+    return kappa_level
+
+
+NUMPY_KERNELS = {
+    "window_exceedances": window_exceedances,
+    "solve_windows": solve_windows,
+    "level_set_lines": level_set_lines,
+}
+
+
+@functools.lru_cache(maxsize=None)
+def _numba_kernels():
+    try:
+        from EffDI import numba_kernels
+    except ImportError:
+        return None
+    return {
+        "window_exceedances": numba_kernels.window_exceedances,
+        "solve_windows": numba_kernels.solve_windows,
+        "level_set_lines": numba_kernels.level_set_lines,
+    }
@@ -0,0 +1,259 @@
+import json
+import os
+import platform
+import shutil
+import tempfile
+import time
+
+import numpy as np
+
+from EffDI.computation import *
+from EffDI.pre_compute_weights import *
+
+BENCHMARK_VERSION = 1
+
+
+def generate_series(
+    n_days=400,
+    level=1000,
+    kappa=10,
+    distribution="gamma",
+    r_amplitude=0.3,
+    period=60,
+    rng=None,
+):
+    """synthetic cumulative incidence series drawn from the model of
+    sample_from_model
+
+    The reported cases of every day are sampled with dispersion kappa around
+    r_eff times the infectious load of the previous days, which starts at
+    level; the load is weighted with the gamma weights of
+    pre_compute_weights. log(r_eff) oscillates with r_amplitude and period,
+    so the level is roughly kept over the series.
+    """
+
+    rng = np.random.default_rng(rng)
+    inv_window_left, inv_window_right = get_inv_window("gamma")
+    inv_weights = compute_inv_weights(inv_window_left, inv_window_right, "gamma")
+
+    # the load of day t is the weighted sum of the cases of the days
+    # t + inv_window_left, ..., t - 1; the weight of day t itself is 0
+    n_pre = -inv_window_left
+    cases = np.full(n_pre + n_days, float(level))
+    r_eff = np.exp(r_amplitude * np.sin(2 * np.pi * np.arange(n_days) / period))
+    for t in range(n_days):
+        load = np.dot(cases[t : n_pre + t], inv_weights[:-1])
+        cases[n_pre + t] = sample_from_model(
+            np.array([load]), [0], r_eff[t], distribution, k=kappa, rng=rng
+        )[0, 0]
+    return np.cumsum(cases[n_pre:]).astype(np.float32)
+
+
+def generate_data_file(filename, n_countries=1, n_days=400, rng=None, **kwargs):
+    """write synthetic series in the format of the JHU time series file,
+    the countries are named "Country 0", "Country 1", ..."""
+
+    seeds = np.random.SeedSequence(rng).spawn(n_countries)
+    dates = np.datetime64("2020-01-22") + np.arange(n_days)
+    header = ["Province/State", "Country/Region", "Lat", "Long"] + [
+        "{}/{}/{}".format(d.month, d.day, d.year % 100) for d in dates.tolist()
+    ]
+    with open(filename, "w") as f:
+        f.write(",".join(header) + "\n")
+        for k, seed in enumerate(seeds):
+            series = generate_series(n_days=n_days, rng=seed, **kwargs)
+            row = ["", "Country {}".format(k), "0", "0"]
+            f.write(",".join(row + ["%d" % v for v in series]) + "\n")
+
+
+def run_benchmark(
+    n_days=400,
+    level=1000,
+    kappa=10,
+    distribution="gamma",
+    n_countries=1,
+    mode="st",
+    tau=[6, 7],
+    k_range=[np.log10(0.1), 4],
+    k_samp=300,
+    n=500,
+    p0s=[0.8, 0.85, 0.9, 0.95],
+    fwd_distribution="delta",
+    inv_distribution="gamma",
+    format="npz",
+    repeat=3,
+    seed=0,
+    **pvals_options
+):
+    """time the stages of the computation of one country on synthetic data
+
+    Every stage is run repeat times; the remaining keyword arguments are
+    passed to get_pvals, e.g. crn or threads. Returns a dict that can be
+    saved as json.
+    """
+
+    fwd_window_left, fwd_window_right = get_fwd_window(fwd_distribution)
+    fwd_weights = compute_fwd_weights(
+        fwd_window_left, fwd_window_right, fwd_distribution
+    )
+    inv_window_left, inv_window_right = get_inv_window(inv_distribution)
+    inv_weights = compute_inv_weights(
+        inv_window_left, inv_window_right, inv_distribution
+    )
+    kappas = np.flip(np.logspace(k_range[0], k_range[1], num=k_samp))
+
+    stages = {}
+    tmp_dir = tempfile.mkdtemp()
+    try:
+        data_file = tmp_dir + "/data.csv"
+        generate_data_file(
+            data_file,
+            n_countries=n_countries,
+            n_days=n_days,
+            rng=seed,
+            level=level,
+            kappa=kappa,
+            distribution=distribution,
+        )
+
+        data_dict = _time_stage(
+            stages, "get_data_dict", repeat, get_data_dict, data_file, cache=False
+        )
+        ts_reported_cases = np.convolve(data_dict["Country 0"], [1, -1], mode="same")
+
+        def weights():
+            return (
+                apply_weights(
+                    ts_reported_cases, fwd_weights, fwd_window_left, fwd_window_right
+                ),
+                apply_weights(
+                    ts_reported_cases, inv_weights, inv_window_left, inv_window_right
+                ),
+            )
+
+        activity, load = _time_stage(stages, "apply_weights", repeat, weights)
+        _time_stage(
+            stages,
+            "get_weighted_series",
+            repeat,
+            get_weighted_series,
+            np.array([data_dict[key] for key in data_dict if key != "dates"]),
+            (inv_weights, inv_window_left, inv_window_right),
+            (fwd_weights, fwd_window_left, fwd_window_right),
+        )
+        _time_stage(
+            stages,
+            "get_r_eff_case",
+            repeat,
+            get_r_eff_case,
+            load,
+            activity,
+            tau[0],
+            tau[1],
+            mode=mode,
+        )
+        pvals, r_eff_case, r_eff_fits = _time_stage(
+            stages,
+            "get_pvals",
+            repeat,
+            get_pvals,
+            load,
+            activity,
+            kappas,
+            tau[0],
+            tau[1],
+            n,
+            distribution,
+            mode=mode,
+            rng=seed,
+            **pvals_options
+        )
+        kappa_levels = _time_stage(
+            stages,
+            "compute_level_set_lines",
+            repeat,
+            compute_level_set_lines,
+            pvals,
+            kappas,
+            p0s,
+        )
+        save_dict = {
+            "pvals": pvals,
+            "dates": data_dict["dates"],
+            "reported_cases": ts_reported_cases,
+            "infectious_load": load,
+            "infectious_activity": activity,
+            "kappas": kappas,
+            "r_eff_case": r_eff_case,
+            "r_eff_fits": r_eff_fits,
+            "kappa_level_set_lines": kappa_levels,
+            "p0s": p0s,
+        }
+        _time_stage(
+            stages,
+            "save_data",
+            repeat,
+            save_data,
+            tmp_dir + "/results",
+            save_dict,
+            format=format,
+        )
+    finally:
+        shutil.rmtree(tmp_dir)
+
+    return {
+        "version": BENCHMARK_VERSION,
+        "time": time.strftime("%Y-%m-%dT%H:%M:%S%z"),
+        "environment": {
+            "python": platform.python_version(),
+            "numpy": np.__version__,
+            "platform": platform.platform(),
+            "cpu_count": os.cpu_count(),
+        },
+        "parameters": {
+            "n_days": n_days,
+            "level": level,
+            "kappa": kappa,
+            "distribution": distribution,
+            "n_countries": n_countries,
+            "mode": mode,
+            "tau": tau,
+            "k_range": k_range,
+            "k_samp": k_samp,
+            "n": n,
+            "p0s": p0s,
+            "fwd_distribution": fwd_distribution,
+            "inv_distribution": inv_distribution,
+            "format": format,
+            "repeat": repeat,
+            "seed": seed,
+            "pvals_options": pvals_options,
+        },
+        "stages": stages,
+    }
+
+
+def benchmark(output=None, **kwargs):
+    """run the benchmark and write the results as json to output or print
+    them"""
+
+    results = run_benchmark(**kwargs)
+    if output is None:
+        print(json.dumps(results, indent=2, default=str))
+        return
+    with open(output, "w") as f:
+        json.dump(results, f, indent=2, default=str)
+
+
+def _time_stage(stages, name, repeat, func, *args, **kwargs):
+    times = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        result = func(*args, **kwargs)
+        times.append(time.perf_counter() - start)
+    stages[name] = {
+        "times": times,
+        "min": min(times),
+        "median": float(np.median(times)),
+    }
+    return result
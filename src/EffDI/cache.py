@@ -0,0 +1,98 @@
+import hashlib
+import json
+import os
+import shutil
+import tempfile
+
+import numpy as np
+
+
+def get_cache_key(arrays, params):
+    """hash of the input arrays and the parameters of a computation"""
+
+    h = hashlib.sha256()
+    for array in arrays:
+        array = np.ascontiguousarray(array)
+        h.update(str(array.dtype).encode())
+        h.update(str(array.shape).encode())
+        h.update(array.tobytes())
+    h.update(json.dumps(params, sort_keys=True, default=str).encode())
+    return h.hexdigest()
+
+
+def get_cache_entry(cache_dir, key):
+    """directory of a cached result, None if there is none"""
+
+    entry = os.path.join(cache_dir, key)
+    try:
+        # mark the entry as recently used
+        os.utime(entry)
+    except FileNotFoundError:
+        return None
+    return entry
+
+
+def restore_from_cache(cache_dir, key, results_dir):
+    """copy a cached result to results_dir, returns False if there is none"""
+
+    entry = os.path.join(cache_dir, key)
+    try:
+        files = os.listdir(entry)
+        if not os.path.exists(results_dir):
+            os.makedirs(results_dir)
+        # the previous results may have been saved in another format
+        for file in os.listdir(results_dir):
+            os.remove(os.path.join(results_dir, file))
+        for file in files:
+            shutil.copyfile(os.path.join(entry, file), os.path.join(results_dir, file))
+        # mark the entry as recently used
+        os.utime(entry)
+    except FileNotFoundError:
+        # no entry, or the entry was evicted by another process meanwhile
+        return False
+    return True
+
+
+def store_in_cache(cache_dir, key, results_dir, max_size):
+    """copy the files of results_dir to the cache and evict old entries"""
+
+    if not os.path.exists(cache_dir):
+        os.makedirs(cache_dir, exist_ok=True)
+
+    # write to a temporary directory first, so that other processes never see
+    # a partially written entry
+    tmp_entry = tempfile.mkdtemp(dir=cache_dir, prefix=".tmp-")
+    for file in os.listdir(results_dir):
+        shutil.copyfile(os.path.join(results_dir, file), os.path.join(tmp_entry, file))
+    try:
+        os.rename(tmp_entry, os.path.join(cache_dir, key))
+    except OSError:
+        # another process stored the same entry first
+        shutil.rmtree(tmp_entry, ignore_errors=True)
+
+    evict_cache(cache_dir, max_size)
+
+
+def evict_cache(cache_dir, max_size):
+    """remove the least recently used entries until the cache is at most
+    max_size bytes large"""
+
+    entries = []
+    for key in os.listdir(cache_dir):
+        entry = os.path.join(cache_dir, key)
+        if key.startswith(".tmp-") or not os.path.isdir(entry):
+            continue
+        try:
+            size = sum(
+                os.path.getsize(os.path.join(entry, file)) for file in os.listdir(entry)
+            )
+            entries.append((os.path.getmtime(entry), size, entry))
+        except FileNotFoundError:
+            continue
+
+    total_size = sum(size for _, size, _ in entries)
+    for _, size, entry in sorted(entries):
+        if total_size <= max_size:
+            break
+        shutil.rmtree(entry, ignore_errors=True)
+        total_size -= size
@@ -1,6 +1,12 @@
+from concurrent.futures import ThreadPoolExecutor
+import functools
+
 import numpy as np
 import os
-import pandas as pd
+
+from EffDI.backends import get_backend
+from EffDI.ingestion import aggregate_groups, load_data_matrix
+from EffDI.profiling import profile_count, profile_stage
 
 
 def apply_weights(data, weights, window_left, window_right):
@@ -12,6 +18,115 @@ def apply_weights(data, weights, window_left, window_right):
     return conv[window_right : window_right + n_days]
 
 
+CONVOLUTION_METHODS = ["auto", "direct", "fft"]
+
+
+def apply_weights_batch(data, weights, window_left, window_right, method="auto"):
+    """apply_weights to the rows of a (series x days) array
+
+    "direct" sums the shifted series, "fft" multiplies with the spectrum of
+    the weights, which is cached per length; "auto" picks the method with
+    fewer operations, which is the fft for long weights. The fft leaves
+    round-off where the exact result is zero, so the days where no nonzero
+    weight meets a nonzero value, found by the fft of the nonzero patterns,
+    are set to zero; days without cases keep a zero load.
+    """
+
+    data = np.asarray(data, dtype=float)
+    n_days = data.shape[1]
+    n_weights = len(weights)
+    assert window_right - window_left + 1 == n_weights
+    n_fft = _get_fft_length(n_days + n_weights - 1)
+    if method == "auto":
+        # operations per series of the sliding sums and of the transforms
+        if n_days * n_weights > 4 * n_fft * np.log2(n_fft):
+            method = "fft"
+        else:
+            method = "direct"
+
+    if method == "direct":
+        # row s of the result is sum_i weights[i] * data[s, t + window_left + i],
+        # days outside the series count as zero
+        pad_before = max(0, -window_left)
+        pad_after = max(0, window_right)
+        padded = np.pad(data, ((0, 0), (pad_before, pad_after)))
+        start = pad_before + window_left
+        windows = np.lib.stride_tricks.sliding_window_view(padded, n_weights, axis=1)
+        return windows[:, start : start + n_days] @ np.asarray(weights, dtype=float)
+    if method != "fft":
+        raise ValueError("unknown convolution method")
+
+    weights = np.asarray(weights, dtype=float)
+    spectrum = _get_weights_spectrum(weights.tobytes(), n_fft)
+    conv = np.fft.irfft(np.fft.rfft(data, n_fft, axis=1) * spectrum, n_fft, axis=1)
+    out = conv[:, window_right : window_right + n_days].copy()
+    # the number of nonzero products of every day is an integer, which the
+    # fft gets to far less than 1/2
+    pattern = _get_weights_spectrum((weights != 0).astype(float).tobytes(), n_fft)
+    n_products = np.fft.irfft(
+        np.fft.rfft(data != 0, n_fft, axis=1) * pattern, n_fft, axis=1
+    )
+    out[n_products[:, window_right : window_right + n_days] < 0.5] = 0.0
+    return out
+
+
+def _get_fft_length(n):
+    from scipy.fft import next_fast_len
+
+    return next_fast_len(n, real=True)
+
+
+@functools.lru_cache(maxsize=32)
+def _get_weights_spectrum(weights, n_fft):
+    # the weights are passed as bytes to be hashable; the cached spectrum is
+    # read-only
+    spectrum = np.fft.rfft(np.flip(np.frombuffer(weights)), n_fft)
+    spectrum.flags.writeable = False
+    return spectrum
+
+
+def get_weighted_series(ts_cumulative, inv_weights, fwd_weights, method="auto"):
+    """reported cases, infectious activity and infectious load of the rows of
+    a (series x days) array of cumulative cases
+
+    The weights are tuples (weights, window_left, window_right) as returned
+    by load_weights. The differences are taken in the same pass on the whole
+    array and not folded into the weights: the cumulative series are orders
+    of magnitude larger than the daily cases, so the convolution of the
+    cumulative series would lose precision.
+    """
+
+    inv_weights, inv_window_left, inv_window_right = inv_weights
+    fwd_weights, fwd_window_left, fwd_window_right = fwd_weights
+
+    # the same differences as np.convolve(ts_cumulative, [1, -1], mode="same")
+    ts_cumulative = np.asarray(ts_cumulative, dtype=float)
+    ts_reported_cases = np.diff(ts_cumulative, axis=1, prepend=0)
+
+    with profile_stage("apply_weights"):
+        ts_infection_activity = apply_weights_batch(
+            ts_reported_cases,
+            fwd_weights,
+            fwd_window_left,
+            fwd_window_right,
+            method=method,
+        )
+        ts_infection_potential = apply_weights_batch(
+            ts_reported_cases,
+            inv_weights,
+            inv_window_left,
+            inv_window_right,
+            method=method,
+        )
+    # Attn: the next line fixed an issue for CH
+    # Should think of  general fix
+    # could be a spatial case that arises for delta distr
+    # could catch this case by values for difference of window_right and window_left
+    if inv_window_left == inv_window_right:
+        ts_infection_potential[ts_reported_cases == 0] = 0
+    return ts_reported_cases, ts_infection_activity, ts_infection_potential
+
+
 def correct_space_in_input(dict, input):
     output = []
     for k in range(len(input)):
@@ -22,17 +137,17 @@ def correct_space_in_input(dict, input):
     return output
 
 
-def get_data_dict(filename):
+def get_data_dict(filename, cache=True, grouping="country"):
     ts_dict = {}
-    data = (
-        pd.read_csv(filename)
-        .drop(["Province/State", "Lat", "Long"], axis=1)
-        .groupby("Country/Region")
-        .sum()
-    )
-    ts_dict["dates"] = pd.to_datetime(data.columns).to_numpy("datetime64[D]")
-    for index in data.index:
-        ts_dict[index] = data.loc[index].values.astype(np.float32)
+    matrix = load_data_matrix(filename, cache=cache)
+
+    # sum the rows of each group with one sparse product, the countries are
+    # sorted as by groupby
+    groups, values = aggregate_groups(matrix, grouping)
+
+    ts_dict["dates"] = matrix["dates"]
+    for index, group in enumerate(groups):
+        ts_dict[group] = values[index]
     return ts_dict
 
 
@@ -45,169 +160,966 @@ def get_pvals(
     n_samples,
     distribution="gamma",
     mode="t",
+    rng=None,
+    threads=1,
+    crn=False,
+    first_day=0,
+    out=None,
+    dtype=np.float64,
+    shared_samples=False,
+    pvalue_method="sampling",
+    backend="numpy",
+    progress=None,
+    r_eff=None,
+    variates_dtype=None,
 ):
-    r_eff_case, r_eff_fits = get_r_eff_case(
-        incid_daily, secondary_infections, tau1, tau2, mode=mode
+    # days before first_day are not fitted, their windows are dropped by
+    # get_sample_windows and their p-values stay nan
+    if crn and shared_samples:
+        raise ValueError("crn can not be combined with shared_samples")
+    if shared_samples and pvalue_method != "sampling":
+        raise ValueError("shared_samples requires pvalue_method sampling")
+    r_eff_case, r_eff_fits, windows = _get_fits_and_windows(
+        incid_daily,
+        secondary_infections,
+        tau1,
+        tau2,
+        mode,
+        first_day,
+        dtype,
+        backend,
+        r_eff,
     )
-    p_vals_full = np.zeros([len(kappas), len(incid_daily)])
+
+    # every kappa gets its own random stream, so that the result does not
+    # depend on the number of threads
+    rng = np.random.default_rng(rng)
+    if crn:
+        add_common_random_numbers(windows, n_samples, rng)
+    kappa_seeds = np.random.SeedSequence(rng.integers(2**63)).spawn(len(kappas))
+
+    # out may be a memory mapped file, then the p-values are written to disk
+    # row by row instead of being kept in memory
+    if out is None:
+        out = np.zeros([len(kappas), len(incid_daily)], dtype=dtype)
+    p_vals_full = out
     p_vals_full[:] = np.nan
-    for k, kappa in enumerate(kappas):
-        p_vals = np.zeros_like(incid_daily)
-        p_vals[:tau1] = np.nan
-        if tau2 != 0:
-            p_vals[-tau2:] = np.nan
-
-        for idx in range(tau1, len(p_vals) - tau2):
-            l = len(r_eff_fits[idx])
-            idxs_nan = np.isnan(r_eff_fits[idx])
-            if np.sum(idxs_nan) > l // 2:
-                p_vals[idx] = np.nan
-            else:
-                sample_idxs = np.array(range(idx - tau1, idx + tau2 + 1))
-                sample_idxs = sample_idxs[~idxs_nan]
 
-                r_eff_fit = r_eff_fits[idx][~idxs_nan]
+    # the fits of mode c have the coefficient as r_eff at every position of
+    # the window, up to rounding
+    r_eff_constant = None
+    if shared_samples and mode == "c":
+        r_eff_constant = r_eff_case[windows["days"]]
 
-                incid_samples = sample_from_model(
+    def fill_rows(rows):
+        for k in rows:
+            if shared_samples:
+                p_vals = get_shared_window_pvals(
+                    windows,
                     incid_daily,
-                    sample_idxs,
-                    r_eff_fit,
+                    tau1,
+                    kappas[k],
+                    n_samples,
+                    distribution,
+                    np.random.default_rng(kappa_seeds[k]),
+                    backend=backend,
+                    r_eff_constant=r_eff_constant,
+                    variates_dtype=variates_dtype,
+                )
+            else:
+                p_vals = get_window_pvals(
+                    windows,
+                    kappas[k],
+                    n_samples,
                     distribution,
-                    n=n_samples,
-                    k=kappa,
+                    np.random.default_rng(kappa_seeds[k]),
+                    method=pvalue_method,
+                    backend=backend,
+                    variates_dtype=variates_dtype,
                 )
+            p_vals_full[k, windows["days"]] = p_vals
+            if progress is not None:
+                # one call per kappa, the sampling of a row dominates
+                progress(len(p_vals))
 
-                means = r_eff_fit * incid_daily[idx - tau1 : idx + tau2 + 1][~idxs_nan]
-                sec_inf = secondary_infections[idx - tau1 : idx + tau2 + 1][~idxs_nan]
+    with profile_stage("pvals"):
+        _map_rows(fill_rows, len(kappas), threads)
+    return p_vals_full, r_eff_case, r_eff_fits
 
-                test_statistic_incid = np.sum(np.square(means - sec_inf))
-                test_statistic_samples = np.sum(
-                    np.square(means - incid_samples), axis=1
-                )
 
-                p_vals[idx] = (
-                    np.sum(test_statistic_samples >= test_statistic_incid) / n_samples
-                )
+def get_pvals_batch(
+    incid_daily,
+    secondary_infections,
+    kappas,
+    tau1,
+    tau2,
+    n_samples,
+    distribution="gamma",
+    mode="t",
+    rng=None,
+    threads=1,
+    crn=False,
+    dtype=np.float64,
+    pvalue_method="sampling",
+    backend="numpy",
+):
+    """get_pvals of the rows of (series x days) arrays
+
+    The windows of all series are stacked, so the fits and the sampling of
+    one kappa are done for all series at once, which pays off for many short
+    series. The series share the random streams of rng, one per kappa, so the
+    p-values of a series depend on the other series of the batch and on their
+    order; a batch of one series gives the p-values of get_pvals with the
+    same rng. Returns the p-values as (series x kappas x days) and r_eff_case
+    and r_eff_fits with the series along the first axis.
+    """
+
+    with profile_stage("r_eff"):
+        r_eff_case, r_eff_fits = get_r_eff_case_batch(
+            incid_daily,
+            secondary_infections,
+            tau1,
+            tau2,
+            mode=mode,
+            backend=backend,
+        )
+    with profile_stage("windows"):
+        windows = get_sample_windows_batch(
+            incid_daily, secondary_infections, r_eff_fits, tau1, tau2, dtype=dtype
+        )
+
+    rng = np.random.default_rng(rng)
+    if crn:
+        add_common_random_numbers(windows, n_samples, rng)
+    kappa_seeds = np.random.SeedSequence(rng.integers(2**63)).spawn(len(kappas))
+
+    n_series, n_days = incid_daily.shape
+    p_vals_full = np.full([n_series, len(kappas), n_days], np.nan, dtype=dtype)
 
-        p_vals_full[k, :] = p_vals
+    def fill_rows(rows):
+        for k in rows:
+            p_vals_full[windows["series"], k, windows["days"]] = get_window_pvals(
+                windows,
+                kappas[k],
+                n_samples,
+                distribution,
+                np.random.default_rng(kappa_seeds[k]),
+                method=pvalue_method,
+                backend=backend,
+            )
+
+    with profile_stage("pvals"):
+        _map_rows(fill_rows, len(kappas), threads)
     return p_vals_full, r_eff_case, r_eff_fits
 
 
+def _map_rows(fill_rows, n_rows, threads):
+    if threads == 1:
+        fill_rows(range(n_rows))
+        return
+    # the random generators and the numpy kernels release the GIL, so the
+    # rows can be filled concurrently; more chunks than threads balance the
+    # load
+    chunks = np.array_split(np.arange(n_rows), 4 * threads)
+    with ThreadPoolExecutor(max_workers=threads) as executor:
+        list(executor.map(fill_rows, chunks))
+
+
+def _get_fits_and_windows(
+    incid_daily,
+    secondary_infections,
+    tau1,
+    tau2,
+    mode,
+    first_day,
+    dtype,
+    backend,
+    r_eff=None,
+):
+    # r_eff may hold r_eff_case and r_eff_fits fitted beforehand with the same
+    # parameters, e.g. shared by the runs of a sweep
+    if r_eff is not None:
+        r_eff_case, r_eff_fits = r_eff
+    else:
+        with profile_stage("r_eff"):
+            r_eff_case, r_eff_fits = get_r_eff_case(
+                incid_daily,
+                secondary_infections,
+                tau1,
+                tau2,
+                mode=mode,
+                first_day=first_day,
+                backend=backend,
+            )
+    with profile_stage("windows"):
+        windows = get_sample_windows(
+            incid_daily, secondary_infections, r_eff_fits, tau1, tau2, dtype=dtype
+        )
+    return r_eff_case, r_eff_fits, windows
+
+
+def get_level_set_lines_adaptive(
+    incid_daily,
+    secondary_infections,
+    kappas,
+    p0s,
+    tau1,
+    tau2,
+    n_samples,
+    distribution="gamma",
+    mode="t",
+    rng=None,
+    crn=False,
+    first_day=0,
+    dtype=np.float64,
+    pvalue_method="sampling",
+    backend="numpy",
+    progress=None,
+    r_eff=None,
+    variates_dtype=None,
+):
+    """level set lines of kappa by bisection over the kappa grid
+
+    The p-values increase along the (descending) kappa grid, so the first
+    kappa with a p-value above p0 can be found with about log2(len(kappas))
+    monte carlo evaluations per day instead of len(kappas). All days are
+    bisected simultaneously. With monte carlo noise the p-values are only
+    monotone up to sampling error, so the result may differ from the dense
+    search by a few grid points where the p-values hover around p0.
+    """
+
+    r_eff_case, r_eff_fits, windows = _get_fits_and_windows(
+        incid_daily,
+        secondary_infections,
+        tau1,
+        tau2,
+        mode,
+        first_day,
+        dtype,
+        backend,
+        r_eff,
+    )
+    rng = np.random.default_rng(rng)
+    if crn:
+        add_common_random_numbers(windows, n_samples, rng)
+    kappas = np.asarray(kappas)
+    n_kappas = len(kappas)
+
+    kappa_level = np.zeros((len(p0s), len(incid_daily)))
+
+    # a larger p0 is exceeded no earlier than a smaller one, so the result for
+    # the previous level is a lower bound for the next one
+    lo = np.zeros(len(windows["days"]), dtype=int)
+    for k in np.argsort(p0s):
+        lo = lo.copy()
+        hi = np.full(len(windows["days"]), n_kappas)
+        active = np.nonzero(lo < hi)[0]
+        while active.size > 0:
+            mid = (lo[active] + hi[active]) // 2
+            with profile_stage("pvals"):
+                p_vals = get_window_pvals(
+                    select_windows(windows, active),
+                    kappas[mid],
+                    n_samples,
+                    distribution,
+                    rng,
+                    method=pvalue_method,
+                    backend=backend,
+                    variates_dtype=variates_dtype,
+                )
+            if progress is not None:
+                progress(len(p_vals))
+            exceeds = p_vals > p0s[k]
+            hi[active[exceeds]] = mid[exceeds]
+            lo[active[~exceeds]] = mid[~exceeds] + 1
+            active = active[lo[active] < hi[active]]
+
+        found = lo < n_kappas
+        kappa_level[k, windows["days"][found]] = kappas[lo[found]]
+    return kappa_level, r_eff_case, r_eff_fits
+
+
+def get_sample_windows(
+    incid_daily, secondary_infections, r_eff_fits, tau1, tau2, dtype=np.float64
+):
+    """stack the fitting windows of all days with at most half of the window missing
+
+    The windows are fitted in float64, dtype is the precision of the sampling
+    and of the test statistics.
+    """
+
+    windows = get_sample_windows_batch(
+        np.asarray(incid_daily)[np.newaxis],
+        np.asarray(secondary_infections)[np.newaxis],
+        np.asarray(r_eff_fits)[np.newaxis],
+        tau1,
+        tau2,
+        dtype=dtype,
+    )
+    del windows["series"]
+    return windows
+
+
+def get_sample_windows_batch(
+    incid_daily, secondary_infections, r_eff_fits, tau1, tau2, dtype=np.float64
+):
+    """get_sample_windows of the rows of (series x days) arrays
+
+    The windows of all series are stacked, "series" holds the row of every
+    window.
+    """
+
+    l = tau1 + tau2 + 1
+    n_series, n_days = incid_daily.shape
+    days = np.arange(tau1, n_days - tau2)
+    if days.size == 0:
+        days = np.zeros(0, dtype=int)
+        incid = np.zeros([n_series, 0, l])
+        sec_inf = np.zeros([n_series, 0, l])
+    else:
+        incid = np.lib.stride_tricks.sliding_window_view(incid_daily, l, axis=1)
+        sec_inf = np.lib.stride_tricks.sliding_window_view(
+            secondary_infections, l, axis=1
+        )
+
+    r_eff = r_eff_fits[:, days]
+    idxs_nan = np.isnan(r_eff)
+    series, keep = np.nonzero(np.sum(idxs_nan, axis=2) <= l // 2)
+    days = days[keep]
+    idxs_nan = idxs_nan[series, keep]
+
+    # masked positions get a zero mean and a zero sampling scale, so that they
+    # do not contribute to the test statistics
+    r_eff = np.where(idxs_nan, 0.0, r_eff[series, keep])
+    incid = np.where(idxs_nan, 0.0, incid[series, days - tau1])
+    sec_inf = np.where(idxs_nan, 0.0, sec_inf[series, days - tau1])
+    means = r_eff * incid
+
+    return {
+        "series": series,
+        "days": days,
+        "r_eff": r_eff.astype(dtype),
+        "incid": incid.astype(dtype),
+        "means": means.astype(dtype),
+        "test_statistic": np.sum(np.square(means - sec_inf), axis=1).astype(dtype),
+    }
+
+
+def add_common_random_numbers(windows, n_samples, rng):
+    """draw one block of uniform variates per window that is shared by all kappas
+
+    The samples for a kappa are obtained by mapping the block through the
+    inverse cdf of the standard gamma distribution with shape kappa (common
+    random numbers). The p-values of neighbouring kappas are then strongly
+    correlated, which smooths the level set lines for the same n. The inverse
+    cdf is tabulated per kappa on a grid in logit space and interpolated
+    linearly; the block stores the grid positions of the uniform variates.
+    """
+
+    from scipy.special import logit
+
+    u = rng.random([len(windows["days"]), n_samples, windows["incid"].shape[1]])
+    profile_count("rng_draws", u.size)
+    step = CRN_LOGIT_GRID[1] - CRN_LOGIT_GRID[0]
+    pos = np.clip(logit(u), CRN_LOGIT_GRID[0], CRN_LOGIT_GRID[-1])
+    pos = (pos - CRN_LOGIT_GRID[0]) / step
+    idx = np.clip(np.floor(pos), 0, len(CRN_LOGIT_GRID) - 2).astype(np.int32)
+    windows["crn_idx"] = idx
+    windows["crn_weight"] = (pos - idx).astype(np.float32)
+
+
+CRN_LOGIT_GRID = np.linspace(-30, 30, 4097)
+
+
+@functools.lru_cache(maxsize=1024)
+def _gamma_quantile_table(k, dtype="<f8"):
+    from scipy.special import expit, gammaincinv
+
+    table = gammaincinv(k, expit(CRN_LOGIT_GRID))
+    return np.stack([table, np.diff(table, append=table[-1])]).astype(dtype)
+
+
+def _crn_samples(idx, weight, scale, k, distribution, rng):
+    dtype = scale.dtype.str
+    k = np.asarray(k)
+    if k.ndim == 0:
+        table = _gamma_quantile_table(float(k), dtype)
+        samples = table[0, idx] + weight * table[1, idx]
+    else:
+        k_unique, k_inverse = np.unique(k, return_inverse=True)
+        tables = np.stack([_gamma_quantile_table(float(v), dtype) for v in k_unique])
+        row = np.reshape(k_inverse, k.shape)
+        samples = tables[row, 0, idx] + weight * tables[row, 1, idx]
+    samples *= scale
+
+    if distribution == "gamma":
+        return samples
+    elif distribution == "NB":
+        # the negative binomial distribution is a gamma-poisson mixture, only
+        # the gamma part uses the common random numbers
+        profile_count("rng_draws", samples.size)
+        return rng.poisson(samples).astype(scale.dtype)
+    else:
+        raise ValueError
+
+
+def select_windows(windows, idxs):
+    return {key: value[idxs] for key, value in windows.items()}
+
+
+def get_window_pvals(
+    windows,
+    kappa,
+    n_samples,
+    distribution,
+    rng,
+    block_size=2**22,
+    method="sampling",
+    backend="numpy",
+    variates_dtype=None,
+):
+    """monte carlo p-values of all stacked windows for a single kappa or for
+    one kappa per window
+
+    With method "analytic" the p-values are approximated by
+    get_window_pvals_analytic, only the windows where the approximation is
+    not reliable are sampled. variates_dtype is the precision in which the
+    random variates are drawn, by default that of the windows; float64
+    variates are rounded to float32 windows, so that both precisions use the
+    same random numbers.
+    """
+
+    if method == "analytic":
+        p_vals = get_window_pvals_analytic(windows, kappa, distribution)
+        sampled = np.nonzero(np.isnan(p_vals))[0]
+        if sampled.size > 0:
+            kappa = np.asarray(kappa)
+            p_vals[sampled] = get_window_pvals(
+                select_windows(windows, sampled),
+                kappa if kappa.ndim == 0 else kappa[sampled],
+                n_samples,
+                distribution,
+                rng,
+                block_size,
+                backend=backend,
+                variates_dtype=variates_dtype,
+            )
+        return p_vals
+    elif method != "sampling":
+        raise ValueError("unknown p-value method")
+
+    dtype = windows["means"].dtype
+    if variates_dtype is None:
+        variates_dtype = dtype
+    # the variates are drawn with the shape in their own precision
+    variates_kappa = np.asarray(kappa, dtype=variates_dtype)
+    kappa = np.asarray(kappa, dtype=dtype)
+    if kappa.ndim == 1:
+        kappa = kappa[:, np.newaxis]
+        variates_kappa = variates_kappa[:, np.newaxis]
+    scale = np.clip(
+        np.clip(windows["r_eff"], None, 100) * windows["incid"] / kappa, 0, None
+    )
+    n_windows, l = scale.shape
+    p_vals = np.empty(n_windows, dtype=dtype)
+    window_exceedances = get_backend(backend)["window_exceedances"]
+
+    # draw at most block_size samples at once to bound the memory footprint
+    step = max(1, block_size // max(1, n_samples * l))
+    for start in range(0, n_windows, step):
+        chunk = slice(start, start + step)
+        if "crn_idx" in windows:
+            samples = _crn_samples(
+                windows["crn_idx"][chunk],
+                windows["crn_weight"][chunk],
+                scale[chunk, np.newaxis, :],
+                (
+                    variates_kappa
+                    if kappa.ndim == 0
+                    else variates_kappa[chunk, np.newaxis]
+                ),
+                distribution,
+                rng,
+            )
+        else:
+            samples = _draw_samples(
+                scale[chunk, np.newaxis, :],
+                (
+                    variates_kappa
+                    if kappa.ndim == 0
+                    else variates_kappa[chunk, np.newaxis]
+                ),
+                distribution,
+                (len(scale[chunk]), n_samples, l),
+                rng,
+                variates_dtype,
+            )
+        p_vals[chunk] = (
+            window_exceedances(
+                samples, windows["means"][chunk], windows["test_statistic"][chunk]
+            )
+            / n_samples
+        )
+    return p_vals
+
+
+# the analytic p-values are used where the skewness of the model is at most
+# this at every position of the window
+ANALYTIC_MAX_SKEWNESS = 0.3
+
+# stirling numbers of the second kind S(n, j) for n = 1, ..., 6
+STIRLING2 = [
+    [1],
+    [1, 1],
+    [1, 3, 1],
+    [1, 7, 6, 1],
+    [1, 15, 25, 10, 1],
+    [1, 31, 90, 65, 15, 1],
+]
+
+
+def get_window_pvals_analytic(
+    windows, kappa, distribution, max_skewness=ANALYTIC_MAX_SKEWNESS
+):
+    """p-values of all stacked windows from a moment matched approximation of
+    the distribution of the test statistic
+
+    The test statistic is a sum of independent squared deviations from the
+    means. Its mean, variance and third cumulant follow in closed form from
+    the cumulants of the model, and it is approximated by a shifted gamma
+    distribution with the same three moments (pearson type III). The
+    p-values of windows where the skewness of the model exceeds max_skewness
+    at some position are nan. Three moments do not determine the shape of a
+    sum in which a few days dominate, so the p-values of such windows are
+    off by up to a few hundredths even for a normal model, about the monte
+    carlo error of 500 samples; the mean error is a few thousandths.
+    """
+
+    from scipy.special import gammaincc, ndtr
+
+    mean, var, k3_stat, reliable = _get_statistic_cumulants(
+        windows, kappa, distribution, max_skewness
+    )
+    t = np.asarray(windows["test_statistic"], dtype=np.float64)
+    with np.errstate(divide="ignore", invalid="ignore"):
+        skewness = k3_stat / var**1.5
+        shape = 4 / skewness**2
+        theta = skewness * np.sqrt(var) / 2
+        shift = mean - shape * theta
+        p_vals = np.where(
+            skewness > 1e-3,
+            gammaincc(shape, np.clip((t - shift) / theta, 0, None)),
+            # a nearly symmetric statistic is approximated as normal
+            1 - ndtr((t - mean) / np.sqrt(var)),
+        )
+    # without variance the statistic is constant
+    p_vals = np.where(var > 0, p_vals, t <= mean)
+    p_vals = np.where(reliable, p_vals, np.nan)
+    return p_vals.astype(windows["means"].dtype)
+
+
+def _get_statistic_cumulants(windows, kappa, distribution, max_skewness):
+    # mean, variance and third cumulant of the test statistic of every window
+    # and whether the skewness of the model is at most max_skewness
+    kappa = np.asarray(kappa, dtype=np.float64)
+    if kappa.ndim == 1:
+        kappa = kappa[:, np.newaxis]
+    r_eff = np.asarray(windows["r_eff"], dtype=np.float64)
+    incid = np.asarray(windows["incid"], dtype=np.float64)
+    scale = np.clip(np.clip(r_eff, None, 100) * incid / kappa, 0, None)
+
+    k1, k2, k3, k4, k5, k6 = _model_cumulants(scale, kappa, distribution)
+    with np.errstate(divide="ignore", invalid="ignore"):
+        skewness = np.where(scale > 0, k3 / k2**1.5, 0)
+    reliable = np.max(skewness, axis=1, initial=0) <= max_skewness
+
+    # central moments of the model and the cumulants of the squared
+    # deviations (x - mean)**2 = (c + delta)**2 with the centered model c
+    m2 = k2
+    m3 = k3
+    m4 = k4 + 3 * k2**2
+    m5 = k5 + 10 * k3 * k2
+    m6 = k6 + 15 * k4 * k2 + 10 * k3**2 + 15 * k2**3
+    delta = k1 - windows["means"]
+    mean = np.sum(m2 + delta**2, axis=1)
+    var = np.sum(m4 - m2**2 + 4 * delta * m3 + 4 * delta**2 * m2, axis=1)
+    k3_stat = np.sum(
+        m6
+        - 3 * m4 * m2
+        + 2 * m2**3
+        + 6 * delta * (m5 - 2 * m2 * m3)
+        + 12 * delta**2 * (m4 - m2**2)
+        + 8 * delta**3 * m3,
+        axis=1,
+    )
+    return mean, var, k3_stat, reliable
+
+
+def _model_cumulants(scale, k, distribution):
+    # the cumulants of gamma(k, scale) are (j - 1)! * k * scale**j; the
+    # negative binomial distribution is a gamma-poisson mixture, whose
+    # cumulants follow from those of the gamma part with stirling numbers
+    gamma_cumulants = [np.prod(np.arange(1, j)) * k * scale**j for j in range(1, 7)]
+    if distribution == "gamma":
+        return gamma_cumulants
+    elif distribution == "NB":
+        return [
+            sum(STIRLING2[n][j] * gamma_cumulants[j] for j in range(n + 1))
+            for n in range(6)
+        ]
+    else:
+        raise ValueError
+
+
+def get_shared_window_pvals(
+    windows,
+    incid_daily,
+    tau1,
+    kappa,
+    n_samples,
+    distribution,
+    rng,
+    block_size=2**22,
+    backend="numpy",
+    r_eff_constant=None,
+    variates_dtype=None,
+):
+    """monte carlo p-values of all stacked windows for a single kappa from one
+    sample per day that is shared by all windows containing the day
+
+    The samples of a window are scale * Z over its days with standard gamma
+    variates Z drawn once per day, so about len(window) times fewer variates
+    are drawn than by get_window_pvals. The p-values of overlapping windows
+    are then correlated: a deviation of the samples of one day shifts the
+    p-values of all windows containing it, so neighbouring days are no longer
+    independent estimates, while the p-value of every single window has the
+    same distribution as before. r_eff_constant is the r_eff of every window
+    if it is constant over the window, as for mode "c"; the test statistics
+    are then computed from cumulative sums over the days instead of from the
+    windows, which is exact up to the rounding of the cumulative sums. Only
+    the gamma distribution can be shared, the negative binomial samples
+    depend on the scale of each window. variates_dtype is as for
+    get_window_pvals.
+    """
+
+    if distribution != "gamma":
+        raise ValueError("shared samples require the gamma distribution")
+
+    dtype = windows["means"].dtype
+    if variates_dtype is None:
+        variates_dtype = dtype
+    variates_kappa = np.asarray(kappa, dtype=variates_dtype)
+    kappa = np.asarray(kappa, dtype=dtype)
+    n_windows, l = windows["means"].shape
+    p_vals = np.zeros(n_windows, dtype=dtype)
+    if n_windows == 0:
+        return p_vals
+    starts = windows["days"] - tau1
+    n_days = starts[-1] + l
+    window_exceedances = get_backend(backend)["window_exceedances"]
+
+    constant = r_eff_constant is not None
+    if not constant:
+        scale = np.clip(
+            np.clip(windows["r_eff"], None, 100) * windows["incid"] / kappa, 0, None
+        )
+    else:
+        # the squared deviations of window d are, with a = scale / incid,
+        # a**2 * incid**2 * Z**2 - 2 * a * r_eff * incid**2 * Z + means**2;
+        # the days without a positive incidence are masked in every window
+        # that contains them, their terms are 0
+        incid = np.asarray(incid_daily[:n_days], dtype=np.float64)
+        u2 = np.where(incid > 0, np.square(incid), 0)
+        r = np.asarray(r_eff_constant, dtype=np.float64)
+        a = np.clip(r, 0, 100) / kappa
+        sum_means = np.sum(np.square(windows["means"], dtype=np.float64), axis=1)
+
+    # draw at most block_size variates at once to bound the memory footprint
+    step = max(1, block_size // (n_days if constant else n_windows * l))
+    for start in range(0, n_samples, step):
+        m = min(step, n_samples - start)
+        z = rng.standard_gamma(variates_kappa, size=(m, n_days), dtype=variates_dtype)
+        z = z.astype(dtype, copy=False)
+        profile_count("rng_draws", z.size)
+        if constant:
+            c2 = _window_sums(u2 * np.square(z, dtype=np.float64), starts, l)
+            c1 = _window_sums(u2 * z, starts, l)
+            test_statistic_samples = sum_means + a**2 * c2 - 2 * a * r * c1
+            p_vals += np.sum(
+                test_statistic_samples >= windows["test_statistic"], axis=0
+            )
+        else:
+            samples = np.lib.stride_tricks.sliding_window_view(z, l, axis=1)[:, starts]
+            samples = np.swapaxes(samples, 0, 1) * scale[:, np.newaxis, :]
+            p_vals += window_exceedances(
+                samples, windows["means"], windows["test_statistic"]
+            )
+    return p_vals / n_samples
+
+
+def _window_sums(values, starts, l):
+    cumsum = np.zeros(values.shape[:-1] + (values.shape[-1] + 1,))
+    np.cumsum(values, axis=-1, out=cumsum[..., 1:])
+    return cumsum[..., starts + l] - cumsum[..., starts]
+
+
 def get_linear_system(incid_daily, secondary_infections, mode="t"):
+    A = np.reshape(incid_daily, [-1, 1]) * get_design_pattern(len(incid_daily), mode)
+    b = np.reshape(secondary_infections, [-1, 1])
+    return A, b
+
+
+def get_design_pattern(n_days, mode="t"):
+    """columns of the linear system before they are multiplied with the incidence"""
+
     if mode == "c":
-        n_cols = 1
+        pattern = np.ones([n_days, 1])
     elif mode == "t":
-        n_cols = 2
+        pattern = np.ones([n_days, 2])
+        pattern[:, 0] = np.arange(n_days)
     elif mode == "st":
-        n_cols = 8
+        pattern = np.zeros([n_days, 8])
+        pattern[:, 0] = np.arange(n_days)
+        pattern[np.arange(n_days), 1 + np.arange(n_days) % 7] = 1
     else:
         raise ValueError("unknown mode")
+    return pattern
 
-    n_days = len(incid_daily)
 
-    A = np.reshape(np.repeat(incid_daily, n_cols), [n_days, n_cols])
-    if mode == "t" or mode == "st":
-        A[:, 0] = np.array(range(n_days)) * A[:, 0]
-    if mode == "st":
-        for k2 in range(1, 8):
-            season_helper = np.zeros(n_days)
-            season_helper[list(range(k2 - 1, n_days, 7))] = 1
-            A[:, k2] = season_helper * A[:, k2]
+def get_r_eff_case(
+    incid_daily,
+    secondary_infections,
+    tau1,
+    tau2,
+    mode="t",
+    first_day=0,
+    backend="numpy",
+):
+    ts_r_eff, r_eff_fits = get_r_eff_case_batch(
+        np.asarray(incid_daily)[np.newaxis],
+        np.asarray(secondary_infections)[np.newaxis],
+        tau1,
+        tau2,
+        mode=mode,
+        first_day=first_day,
+        backend=backend,
+    )
+    return ts_r_eff[0], r_eff_fits[0]
 
-    b = np.reshape(secondary_infections, [-1, 1])
-    return A, b
 
+def get_r_eff_case_batch(
+    incid_daily,
+    secondary_infections,
+    tau1,
+    tau2,
+    mode="t",
+    first_day=0,
+    backend="numpy",
+):
+    """get_r_eff_case of the rows of (series x days) arrays, the windows of
+    all series are solved at once"""
 
-def get_r_eff_case(incid_daily, secondary_infections, tau1, tau2, mode="t"):
     n_days = tau1 + tau2 + 1
+    n_series, n_total = incid_daily.shape
 
     ts_r_eff = np.zeros_like(incid_daily)
-    ts_r_eff[0:tau1] = np.nan
+    ts_r_eff[:, 0 : max(tau1, first_day)] = np.nan
     if tau2 != 0:
-        ts_r_eff[-tau2:] = np.nan
+        ts_r_eff[:, -tau2:] = np.nan
 
-    r_eff_fits = np.empty([len(incid_daily), n_days])
+    r_eff_fits = np.empty([n_series, n_total, n_days])
     r_eff_fits[:] = np.nan
 
-    for k in range(tau1, len(ts_r_eff) - tau2):
-        # define linear system
-        A, b = get_linear_system(
-            incid_daily[k - tau1 : k + tau2 + 1],
-            secondary_infections[k - tau1 : k + tau2 + 1],
-            mode,
-        )
+    days = np.arange(max(tau1, first_day), n_total - tau2)
+    if days.size == 0 or n_series == 0:
+        return ts_r_eff, r_eff_fits
 
-        # only fith where daily incid is nonzero
-        incid_gt_zero = incid_daily[k - tau1 : k + tau2 + 1] > 0
-        weekday_gt_zero = [np.sum(incid_gt_zero[k::7]) for k in range(7)]
-        b2 = b[incid_gt_zero]
-        A2 = A[incid_gt_zero, :]
-
-        # solve linear system
-        coeffs = np.matmul(np.linalg.pinv(A2), b2)
-
-        # compute r_eff case
-        x = incid_daily[k - tau1 : k + tau2 + 1]
-        x2 = x[incid_gt_zero]
-
-        r_eff_fits[k, ~incid_gt_zero] = np.nan
-        r_eff_fits[k, incid_gt_zero] = np.divide(np.squeeze(np.matmul(A2, coeffs)), x2)
-
-        if mode == "c":
-            ts_r_eff[k] = coeffs[0]
-        if mode == "t":
-            ts_r_eff[k] = coeffs[0] * tau1 + coeffs[1]
-        if mode == "st":
-            if np.sum(incid_gt_zero) > 0:
-                ts_r_eff[k] = coeffs[0] * tau1 + np.sum(
-                    np.reshape(weekday_gt_zero, [7, 1]) * coeffs[1:]
-                ) / np.sum(incid_gt_zero)
-            else:
-                ts_r_eff[k] = np.nan
-    return ts_r_eff, r_eff_fits
+    # define the linear systems of all windows at once
+    x = np.lib.stride_tricks.sliding_window_view(incid_daily, n_days, axis=1)
+    x = x[:, days - tau1].reshape(-1, n_days)
+    y = np.lib.stride_tricks.sliding_window_view(secondary_infections, n_days, axis=1)
+    y = y[:, days - tau1].reshape(-1, n_days)
+    pattern = get_design_pattern(n_days, mode)
 
+    # only fit where daily incid is nonzero; zeroing the remaining rows leaves
+    # the minimum norm least squares solution of pinv unchanged
+    incid_gt_zero = x > 0
+    x2 = np.where(incid_gt_zero, x, 0.0)
+    A = x2[:, :, np.newaxis] * pattern
+    b = np.where(incid_gt_zero, y, 0.0)
 
-def sample_from_model(incid_daily, sample_idxs, r_eff, distribution, n=1, k=0.5):
-    samples = np.empty([n, len(sample_idxs)])
-    samples[:] = np.nan
-    for j, idx in enumerate(sample_idxs):
-        if distribution == "gamma":
-            samples[:, j] = np.random.gamma(
-                k,
-                scale=np.clip(
-                    (np.clip(r_eff[j], None, 100) * incid_daily[idx]) / k, 0, None
-                ),
-                size=n,
-            )
-        elif distribution == "NB":
-            p = 1 / (
-                1
-                + np.clip(
-                    (np.clip(r_eff[j], None, 100) * incid_daily[idx]) / k, 0, None
-                )
+    # solve all linear systems at once
+    coeffs = get_backend(backend)["solve_windows"](A, b)
+    # one stacked pinv solves all windows, the counter is the number of
+    # least squares problems
+    profile_count("lstsq_windows", len(A))
+
+    # compute r_eff case
+    fits = np.matmul(A, coeffs[:, :, np.newaxis])[:, :, 0]
+    fits = np.where(incid_gt_zero, fits / np.where(incid_gt_zero, x, 1.0), np.nan)
+    r_eff_fits[:, days] = fits.reshape(n_series, len(days), n_days)
+
+    if mode == "c":
+        r_eff = coeffs[:, 0]
+    if mode == "t":
+        r_eff = coeffs[:, 0] * tau1 + coeffs[:, 1]
+    if mode == "st":
+        n_gt_zero = np.sum(incid_gt_zero, axis=1)
+        weekday_gt_zero = np.matmul(incid_gt_zero, pattern[:, 1:])
+        with np.errstate(invalid="ignore", divide="ignore"):
+            r_eff = np.where(
+                n_gt_zero > 0,
+                coeffs[:, 0] * tau1
+                + np.sum(weekday_gt_zero * coeffs[:, 1:], axis=1) / n_gt_zero,
+                np.nan,
             )
-            samples[:, j] = np.random.negative_binomial(k, p, size=n)
-        else:
-            raise ValueError
-    return samples
+    ts_r_eff[:, days] = r_eff.reshape(n_series, len(days))
+    return ts_r_eff, r_eff_fits
+
 
+def sample_from_model(
+    incid_daily, sample_idxs, r_eff, distribution, n=1, k=0.5, rng=None
+):
+    rng = np.random.default_rng(rng)
+    scale = np.clip((np.clip(r_eff, None, 100) * incid_daily[sample_idxs]) / k, 0, None)
+    return _draw_samples(scale, k, distribution, (n, len(sample_idxs)), rng)
+
+
+def _draw_samples(scale, k, distribution, size, rng, dtype=None):
+    # dtype is the precision of the variates, by default that of scale
+    if dtype is None:
+        dtype = scale.dtype
+    profile_count("rng_draws", np.prod(size))
+    if distribution == "gamma":
+        # gamma(k, scale) is scale * standard_gamma(k); drawing with a scalar
+        # shape avoids broadcasting in the generator
+        z = rng.standard_gamma(k, size=size, dtype=dtype)
+        return z.astype(scale.dtype, copy=False) * scale
+    elif distribution == "NB":
+        p = 1 / (1 + scale.astype(dtype, copy=False))
+        return rng.negative_binomial(k, p, size=size).astype(scale.dtype)
+    else:
+        raise ValueError
+
+
+def compute_level_set_lines(pvals, kappas, p0s, backend="numpy"):
+    return get_backend(backend)["level_set_lines"](pvals, np.asarray(kappas), p0s)
+
+
+def compute_level_set_lines_batch(pvals, kappas, p0s, backend="numpy"):
+    """compute_level_set_lines of (series x kappas x days) p-values, returns
+    (series x p0s x days)"""
+
+    n_series, n_kappas, n_days = pvals.shape
+    pvals = np.moveaxis(pvals, 0, 1).reshape(n_kappas, n_series * n_days)
+    levels = compute_level_set_lines(pvals, kappas, p0s, backend=backend)
+    return np.moveaxis(levels.reshape(len(p0s), n_series, n_days), 1, 0)
+
+
+def get_accuracy_report(results, reference, n_samples):
+    """deviation of results computed with reduced precision from float64
+    results with the same parameters and seed
+
+    The results should be computed with float64 variates, see
+    get_window_pvals; the generator draws float32 variates with a different
+    algorithm, and the deviation would be monte carlo noise. For the negative
+    binomial distribution a rounded rate can still change a poisson count,
+    which shifts the remaining variates of that kappa. The deviation is
+    compared to the standard error of a p-value of 0.5.
+    """
+
+    report = {"monte_carlo_standard_error": 0.5 / np.sqrt(n_samples)}
+    if "pvals" in results and "pvals" in reference:
+        pvals = np.asarray(results["pvals"], dtype=np.float64)
+        nan_mismatch = np.isnan(pvals) != np.isnan(reference["pvals"])
+        both = ~np.isnan(pvals) & ~np.isnan(reference["pvals"])
+        diff = np.abs(pvals - reference["pvals"])[both]
+        report["pvals_nan_mismatch"] = int(np.sum(nan_mismatch))
+        report["pvals_max_abs_diff"] = float(np.max(diff, initial=0))
+        report["pvals_mean_abs_diff"] = float(np.mean(diff)) if diff.size else 0.0
+
+    levels = results["kappa_level_set_lines"]
+    levels_ref = reference["kappa_level_set_lines"]
+    both = (levels > 0) & (levels_ref > 0)
+    log_ratio = np.abs(np.log10(levels[both] / levels_ref[both]))
+    report["kappa_level_zero_mismatch"] = int(np.sum((levels > 0) != (levels_ref > 0)))
+    report["kappa_level_max_abs_log10_ratio"] = float(np.max(log_ratio, initial=0))
+    report["kappa_level_mean_abs_log10_ratio"] = (
+        float(np.mean(log_ratio)) if log_ratio.size else 0.0
+    )
+    return report
 
-def compute_level_set_lines(pvals, kappas, p0s):
-    kappa_level = np.zeros((len(p0s), len(pvals[0])))
-    for k in range(len(p0s)):
-        for j in range(pvals.shape[1]):
-            for i in range(pvals.shape[0]):
-                if pvals[i, j] > p0s[k]:
-                    kappa_level[k, j] = kappas[i]
-                    break
-    return kappa_level
 
+# variables of the results that are given per day and the axis of the days
+DAY_AXES = {
+    "pvals": 1,
+    "dates": 0,
+    "reported_cases": 0,
+    "infectious_load": 0,
+    "infectious_activity": 0,
+    "r_eff_case": 0,
+    "r_eff_fits": 0,
+    "kappa_level_set_lines": 1,
+}
+
+
+def save_data(dir, dict, format="npz"):
+    """save results either compressed in pvals.npz or as one .npy file per
+    variable, which can be memory mapped by load_data"""
 
-def save_data(dir, dict):
     if not os.path.exists(dir):
         os.makedirs(dir)
-    np.savez_compressed(dir + "/pvals.npz", **dict)
+
+    # remove the files of earlier results, so that load_data does not mix
+    # formats or pick up stale variables
+    for file in os.listdir(dir):
+        if file == "pvals.npz" or file.endswith(".npy"):
+            os.remove(dir + "/" + file)
+
+    if format == "npz":
+        np.savez_compressed(dir + "/pvals.npz", **dict)
+        header = "The file pvals.npz contains the following variables:\n"
+    elif format == "npy":
+        for key, value in dict.items():
+            # write to a new file, arrays of the previous results that are
+            # still memory mapped stay valid
+            tmp_file = dir + "/" + key + ".npy.tmp"
+            if isinstance(value, np.memmap) and os.path.abspath(
+                value.filename
+            ) == os.path.abspath(tmp_file):
+                # the array was computed directly into its file
+                value.flush()
+            else:
+                with open(tmp_file, "wb") as f:
+                    np.save(f, value)
+            os.replace(tmp_file, dir + "/" + key + ".npy")
+        header = "The .npy files contain the following variables:\n"
+    else:
+        raise ValueError("unknown format")
+
     with open(dir + "/info.txt", "w") as f:
-        print("The file pvals.npz contains the following variables:\n", file=f)
+        print(header, file=f)
         for key in dict:
             print(key, file=f)
+
+
+def has_data(dir):
+    return os.path.exists(dir + "/pvals.npz") or os.path.exists(dir + "/dates.npy")
+
+
+def load_data(dir, mmap=True):
+    """load results saved by save_data; arrays saved as .npy files are memory
+    mapped, so only the variables that are used are read"""
+
+    if os.path.exists(dir + "/pvals.npz"):
+        return dict(np.load(dir + "/pvals.npz"))
+
+    data = {}
+    for file in sorted(os.listdir(dir)):
+        if file.endswith(".npy"):
+            data[file[: -len(".npy")]] = np.load(
+                dir + "/" + file, mmap_mode="r" if mmap else None
+            )
+    if not data:
+        raise FileNotFoundError("no results in " + dir)
+    return data
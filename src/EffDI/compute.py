@@ -1,70 +1,465 @@
-
-import csv
+from concurrent.futures import ProcessPoolExecutor
+import functools
+import hashlib
+import json
+import multiprocessing
+import shutil
+import tempfile
+import threading
+import warnings
 
 import pandas as pd
 
+from EffDI.backends import *
+from EffDI.cache import *
 from EffDI.computation import *
+from EffDI.ingestion import *
+from EffDI.pre_compute_weights import *
+from EffDI.profiling import *
+from EffDI.progress import *
+from EffDI.store import *
 
 
 
 def compute(data_file="time_series_covid19_confirmed_global.csv",
-            inv_weights="inv_weights.csv",
-            fwd_weights="fwd_weights.csv",
+            inv_weights="inv_weights.npz",
+            fwd_weights="fwd_weights.npz",
             countries=["Austria"],
             mode="st",
             tau=[6, 7],
             k_range=[np.log10(0.1), 4],
             k_samp=300,
             n=500,
-            distribution="gamma"):
+            distribution="gamma",
+            workers=1,
+            threads=1,
+            seed=None,
+            p0s=[0.8, 0.85, 0.9, 0.95],
+            kappa_search="dense",
+            full_pvals=False,
+            crn=False,
+            incremental=False,
+            cache_dir=None,
+            cache_size=1024,
+            data_cache=True,
+            format="npz",
+            store=None,
+            stream=False,
+            dtype="float64",
+            accuracy_report=False,
+            shared_samples=False,
+            pvalue_method="sampling",
+            backend="numpy",
+            profile=False,
+            cprofile=False,
+            progress="none",
+            grouping="country",
+            batch=False,
+            batch_size=256):
+
+
+    if accuracy_report and dtype == "float64":
+        raise ValueError(
+            "accuracy_report compares a reduced precision with float64, use it "
+            "with dtype float32"
+        )
+
+    # grouping is "country", "province" or a json file with custom groups
+    if grouping not in ["country", "province"]:
+        grouping = load_grouping(os.path.expanduser(grouping))
+
+    # load inv and fwd weights
+    weights = {
+        "inv": load_weights(inv_weights, "inv"),
+        "fwd": load_weights(fwd_weights, "fwd"),
+    }
 
+    params = {
+        "mode": mode,
+        "tau": tau,
+        "k_range": k_range,
+        "k_samp": k_samp,
+        "n": n,
+        "distribution": distribution,
+        "threads": threads,
+        "p0s": p0s,
+        "kappa_search": kappa_search,
+        "full_pvals": full_pvals,
+        "crn": crn,
+        "dtype": dtype,
+        "shared_samples": shared_samples,
+        "pvalue_method": pvalue_method,
+        "backend": resolve_backend(backend),
+    }
 
-    data_dict = get_data_dict(os.path.expanduser(data_file))
+    if stream:
+        if (workers != 1 or incremental or cache_dir is not None or store is not None
+                or accuracy_report or batch):
+            raise ValueError(
+                "stream can not be combined with workers, incremental, cache_dir, "
+                "store, accuracy_report or batch"
+            )
+        matrix = load_data_matrix(os.path.expanduser(data_file), cache=data_cache)
+        groups = get_group_membership(matrix, grouping)[0]
+        if countries is None:
+            countries = groups
+        countries = correct_space_in_input(dict.fromkeys(groups), countries)
+        report = _get_progress(progress, countries, len(matrix["dates"]), params)
+        if report is not None:
+            report("run_start")
+        # the series are summed from the same matrix, the file is parsed once
+        compute_stream(
+            iter_groups(matrix, countries, grouping=grouping),
+            matrix["dates"],
+            weights["inv"],
+            weights["fwd"],
+            seed=seed,
+            profile=profile or cprofile,
+            cprofile=cprofile,
+            progress=report,
+            **params
+        )
+        if report is not None:
+            report("run_done")
+        return
+
+    data_dict = get_data_dict(
+        os.path.expanduser(data_file), cache=data_cache, grouping=grouping
+    )
+    # all groups without a selection
+    if countries is None:
+        countries = [key for key in data_dict if key != "dates"]
     # correct the country keys for countries that one space in them
     countries = correct_space_in_input(data_dict, countries)
 
-    inv_weights_content = []
-    fwd_weights_content = []
-    # load inv and fwd weights
-    with open(inv_weights) as csv_file:
-        csv_reader = csv.reader(csv_file, delimiter=",")
-        for row in csv_reader:
-            inv_weights_content.append(np.array(row, dtype=float))
-
-    inv_window_left = int(np.amin(inv_weights_content[0]))
-    inv_window_right = int(np.amax(inv_weights_content[0]))
-    inv_weights = inv_weights_content[1]
-
-    with open(fwd_weights) as csv_file:
-        csv_reader = csv.reader(csv_file, delimiter=",")
-        for row in csv_reader:
-            fwd_weights_content.append(np.array(row, dtype=float))
-
-    fwd_window_left = int(np.amin(fwd_weights_content[0]))
-    fwd_window_right = int(np.amax(fwd_weights_content[0]))
-    fwd_weights = fwd_weights_content[1]
-
-    for country in countries:
-        ts_reported_cases = np.convolve(data_dict[country], [1, -1], mode="same")
-        ts_dates = data_dict["dates"]
-
-        ts_infection_activity = apply_weights(
-            ts_reported_cases, fwd_weights, fwd_window_left, fwd_window_right
+    if batch:
+        adaptive = kappa_search == "adaptive" and not full_pvals
+        if (workers != 1 or incremental or cache_dir is not None or accuracy_report
+                or profile or cprofile or adaptive):
+            raise ValueError(
+                "batch can not be combined with workers, incremental, cache_dir, "
+                "accuracy_report, profiling or the adaptive kappa search"
+            )
+        report = _get_progress(progress, countries, len(data_dict["dates"]), params)
+        if report is not None:
+            report("run_start")
+        del params["threads"], params["kappa_search"], params["full_pvals"]
+        # the countries of a batch share the random streams, seeded by their
+        # names, so the p-values depend on the batches and differ from those
+        # without batch by monte carlo noise, except for batches of one
+        # country; the dense p-values of a batch are held in memory
+        root_seed = np.random.SeedSequence(seed)
+        for start in range(0, len(countries), batch_size):
+            chunk = countries[start:start + batch_size]
+            results = compute_batch(
+                np.array([data_dict[country] for country in chunk]),
+                weights["inv"],
+                weights["fwd"],
+                rng=get_country_seed(root_seed, "\n".join(chunk)),
+                threads=threads,
+                **params
+            )
+            for k, country in enumerate(chunk):
+                # kappas, p0s and the run parameters are shared by all series
+                shared = ["kappas", "p0s", "run_parameters"]
+                save_dict = {"pvals": results["pvals"][k],
+                             "dates": data_dict["dates"]}
+                for key, value in results.items():
+                    if key not in save_dict:
+                        save_dict[key] = value if key in shared else value[k]
+                if store is None:
+                    save_data(get_results_dir(country, mode), save_dict, format=format)
+                else:
+                    _save_to_store(store, country, mode, save_dict)
+                if report is not None:
+                    report("country_done", country)
+        if report is not None:
+            report("run_done")
+        return
+
+    options = {
+        "incremental": incremental,
+        "cache_dir": cache_dir,
+        "cache_size": cache_size * 2**20,
+        "seeded": seed is not None,
+        "format": format,
+        "store": store,
+        "accuracy_report": accuracy_report,
+        "profile": profile or cprofile,
+        "cprofile": cprofile,
+    }
+
+    # one independent random stream per country, so that results do not
+    # depend on the number of workers, the order of execution or the other
+    # countries of the run
+    root_seed = np.random.SeedSequence(seed)
+    seeds = [get_country_seed(root_seed, country) for country in countries]
+
+    # the weights are applied to all countries in one batch; when profiling,
+    # every country applies its own weights, so that the apply_weights stage
+    # is part of its profile; the results are the same
+    weighted = {}
+    if not options["profile"]:
+        reported, activity, load = get_weighted_series(
+            np.reshape([data_dict[country] for country in countries],
+                       (len(countries), len(data_dict["dates"]))),
+            weights["inv"],
+            weights["fwd"],
+        )
+        weighted = {
+            country: (reported[k], activity[k], load[k])
+            for k, country in enumerate(countries)
+        }
+
+    report = _get_progress(progress, countries, len(data_dict["dates"]), params)
+    if report is not None:
+        report("run_start")
+
+    if workers == 1:
+        _init_worker(data_dict, weights, params, options, report, weighted)
+        for country, country_seed in zip(countries, seeds):
+            save_dict = _compute_and_save(country, country_seed)
+            _save_to_store(store, country, mode, save_dict)
+    else:
+        # the workers send their progress events through a queue to a thread
+        # of this process
+        queue = None
+        if report is not None:
+            queue = multiprocessing.Queue()
+            listener = threading.Thread(target=listen_progress, args=(queue, report))
+            listener.start()
+
+        # the workers receive data_dict and the weights once at start-up
+        # instead of with every task
+        try:
+            with ProcessPoolExecutor(
+                max_workers=workers,
+                initializer=_init_worker,
+                initargs=(data_dict, weights, params, options, queue, weighted),
+            ) as executor:
+                futures = [
+                    executor.submit(_compute_and_save, country, country_seed)
+                    for country, country_seed in zip(countries, seeds)
+                ]
+                # the store is only written by this process
+                for country, future in zip(countries, futures):
+                    _save_to_store(store, country, mode, future.result())
+        finally:
+            if queue is not None:
+                queue.put(None)
+                listener.join()
+
+    if report is not None:
+        report("run_done")
+
+
+def compute_stream(series,
+                   dates,
+                   inv_weights,
+                   fwd_weights,
+                   seed=None,
+                   profile=False,
+                   cprofile=False,
+                   progress=None,
+                   **params):
+    """compute and save the results of (country, cumulative series) pairs
+    taken one at a time from an iterator
+
+    The p-values are written to results/<country>_<mode>/pvals.npy while
+    they are computed and every country is released before the next one is
+    taken, so the memory is bounded by the working set of one series.
+    """
+
+    root_seed = np.random.SeedSequence(seed)
+    for country, ts_cumulative in series:
+        results_dir = get_results_dir(country, params["mode"])
+        if not os.path.exists(results_dir):
+            os.makedirs(results_dir)
+        if profile:
+            start_profile(cprofile=cprofile)
+        if progress is not None:
+            progress("country_start", country)
+
+        with profile_stage("compute"):
+            results = compute_country(
+                ts_cumulative,
+                inv_weights,
+                fwd_weights,
+                rng=np.random.default_rng(get_country_seed(root_seed, country)),
+                pvals_file=results_dir + "/pvals.npy.tmp",
+                progress=_get_chunk_progress(progress, country),
+                **params
+            )
+
+        save_dict = {}
+        if "pvals" in results:
+            save_dict["pvals"] = results.pop("pvals")
+        save_dict["dates"] = dates
+        save_dict.update(results)
+        with profile_stage("save"):
+            save_data(results_dir, save_dict, format="npy")
+
+        if profile:
+            report, cprofile_stats = stop_profile()
+            _save_profile(results_dir, country, params["mode"], report, cprofile_stats)
+        if progress is not None:
+            progress("country_done", country)
+
+
+def get_country_seed(root_seed, country):
+    """SeedSequence of country, derived from the entropy of root_seed and the
+    name of the country, so that it does not depend on the selection of
+    countries"""
+
+    digest = hashlib.sha256(country.encode("utf-8")).digest()
+    spawn_key = tuple(
+        int.from_bytes(digest[k : k + 4], "little") for k in range(0, 16, 4)
+    )
+    return np.random.SeedSequence(root_seed.entropy, spawn_key=spawn_key)
+
+
+def get_results_dir(country, mode):
+    country_str = country.replace(" ", "").replace(",", "").lower()
+    return "results/" + country_str + "_" + mode
+
+
+def load_weights(filename, kind=None):
+    """(weights, window_left, window_right) from a weights file, or computed
+    in memory if filename is the name of a distribution
+
+    A file is read once per process as long as it does not change. The csv
+    file of earlier versions is read if the .npz file does not exist. If
+    neither exists, the weights of kind ("inv" or "fwd") are computed with
+    the default distribution of pre_compute_weights.
+    """
+
+    if filename in WEIGHT_PARAMETERS:
+        return get_weights(kind, filename)
+    filename = os.path.expanduser(filename)
+    if not os.path.exists(filename) and filename.endswith(".npz"):
+        if os.path.exists(filename[:-4] + ".csv"):
+            filename = filename[:-4] + ".csv"
+    if not os.path.exists(filename) and kind is not None:
+        distribution = DEFAULT_WEIGHT_DISTRIBUTIONS[kind]
+        warnings.warn(
+            "{} does not exist, using the {} weights".format(filename, distribution)
         )
+        return get_weights(kind, distribution)
+    stat = os.stat(filename)
+    return _load_weights_file(
+        os.path.abspath(filename), stat.st_mtime_ns, stat.st_size, kind
+    )
+
+
+@functools.lru_cache(maxsize=16)
+def _load_weights_file(filename, mtime, size, kind):
+    # the modification time and size invalidate the cached weights
+    weights, window_left, window_right = read_weights(filename, kind)
+    weights.flags.writeable = False
+    return weights, window_left, window_right
+
+
+def compute_country(ts_cumulative,
+                    inv_weights,
+                    fwd_weights,
+                    mode="st",
+                    tau=[6, 7],
+                    k_range=[np.log10(0.1), 4],
+                    k_samp=300,
+                    n=500,
+                    distribution="gamma",
+                    rng=None,
+                    threads=1,
+                    p0s=[0.8, 0.85, 0.9, 0.95],
+                    kappa_search="dense",
+                    full_pvals=False,
+                    crn=False,
+                    dtype="float64",
+                    shared_samples=False,
+                    pvalue_method="sampling",
+                    backend="numpy",
+                    previous=None,
+                    pvals_file=None,
+                    progress=None,
+                    weighted=None,
+                    r_eff=None,
+                    variates_dtype=None):
+
+    # weighted holds the reported cases, activity and load of this country
+    # from a batch of get_weighted_series; the rows of a batch do not depend
+    # on each other, so a single series gives the same values
+    if weighted is None:
+        weighted = [
+            series[0]
+            for series in get_weighted_series(
+                np.asarray(ts_cumulative)[np.newaxis], inv_weights, fwd_weights
+            )
+        ]
+    ts_reported_cases, ts_infection_activity, ts_infection_potential = weighted
+
+    kappas = np.flip(np.logspace(k_range[0], k_range[1], num=k_samp))
 
-        ts_infection_potential = apply_weights(
-            ts_reported_cases, inv_weights, inv_window_left, inv_window_right
+    if shared_samples and kappa_search == "adaptive" and not full_pvals:
+        raise ValueError("shared_samples requires the p-values of all kappas")
+
+    # with full_pvals the adaptive search computes the dense p-values
+    run_parameters = get_run_parameters(
+        mode=mode,
+        tau=tau,
+        distribution=distribution,
+        n=n,
+        crn=crn,
+        dtype=dtype,
+        shared_samples=shared_samples,
+        pvalue_method=pvalue_method,
+        kappa_search="dense" if full_pvals else kappa_search,
+    )
+
+    # with previous results only the days whose fitting window overlaps with
+    # changed or new data are recomputed
+    first_day = 0
+    if previous is not None:
+        first_day = get_first_changed_day(
+            previous,
+            ts_infection_potential,
+            ts_infection_activity,
+            kappas,
+            p0s,
+            tau,
+            kappa_search == "dense" or full_pvals,
+            run_parameters,
         )
-        # Attn: the next line fixed an issue for CH
-        # Should think of  general fix
-        # could be a spatial case that arises for delta distr
-        # could catch this case by values for difference of window_right and window_left
-        # ts_infection_potential[ts_reported_cases == 0] = 0
-        if inv_window_left == inv_window_right:
-            ts_infection_potential[ts_reported_cases == 0] = 0
 
-        kappas = np.flip(np.logspace(k_range[0], k_range[1], num=k_samp))
+    pvals_out = None
+    if pvals_file is not None and (kappa_search == "dense" or full_pvals):
+        pvals_out = np.lib.format.open_memmap(
+            pvals_file, mode="w+", dtype=dtype, shape=(len(kappas), len(ts_cumulative))
+        )
 
+    results = {}
+    if kappa_search == "adaptive" and not full_pvals:
+        # only the level set lines, the full p-value matrix is skipped
+        kappa_levels, r_eff_case, r_eff_fits = get_level_set_lines_adaptive(
+            ts_infection_potential,
+            ts_infection_activity,
+            kappas,
+            p0s,
+            tau[0],
+            tau[1],
+            n,
+            distribution,
+            mode=mode,
+            rng=rng,
+            crn=crn,
+            first_day=first_day,
+            dtype=dtype,
+            pvalue_method=pvalue_method,
+            backend=backend,
+            progress=progress,
+            r_eff=r_eff,
+            variates_dtype=variates_dtype,
+        )
+    else:
         pvals, r_eff_case, r_eff_fits = get_pvals(
             ts_infection_potential,
             ts_infection_activity,
@@ -74,25 +469,380 @@ def compute(data_file="time_series_covid19_confirmed_global.csv",
             n,
             distribution,
             mode=mode,
+            rng=rng,
+            threads=threads,
+            crn=crn,
+            first_day=first_day,
+            out=pvals_out,
+            dtype=dtype,
+            shared_samples=shared_samples,
+            pvalue_method=pvalue_method,
+            backend=backend,
+            progress=progress,
+            r_eff=r_eff,
+            variates_dtype=variates_dtype,
+        )
+        results["pvals"] = pvals
+
+        with profile_stage("level_set_lines"):
+            kappa_levels = compute_level_set_lines(
+                pvals, kappas, p0s, backend=backend
+            )
+
+    results.update({
+        "reported_cases": ts_reported_cases,
+        "infectious_load": ts_infection_potential,
+        "infectious_activity": ts_infection_activity,
+        "kappas": kappas,
+        "r_eff_case": r_eff_case,
+        "r_eff_fits": r_eff_fits,
+        "kappa_level_set_lines": kappa_levels,
+        "p0s": p0s,
+        "run_parameters": run_parameters,
+    })
+
+    if first_day > 0:
+        for key in ["pvals", "r_eff_case", "r_eff_fits", "kappa_level_set_lines"]:
+            if key in results:
+                prefix = [slice(None)] * results[key].ndim
+                prefix[DAY_AXES[key]] = slice(0, first_day)
+                results[key][tuple(prefix)] = previous[key][tuple(prefix)]
+    return results
+
+
+def compute_batch(ts_cumulative,
+                  inv_weights,
+                  fwd_weights,
+                  mode="st",
+                  tau=[6, 7],
+                  k_range=[np.log10(0.1), 4],
+                  k_samp=300,
+                  n=500,
+                  distribution="gamma",
+                  rng=None,
+                  threads=1,
+                  p0s=[0.8, 0.85, 0.9, 0.95],
+                  crn=False,
+                  dtype="float64",
+                  shared_samples=False,
+                  pvalue_method="sampling",
+                  backend="numpy"):
+    """compute_country of the rows of a (series x days) array of cumulative
+    series in one pass
+
+    The weights, fits, monte carlo draws and level set lines are vectorized
+    over all series, which avoids the per-country overhead for many short
+    series. The series share the random streams of rng, so their p-values
+    and level set lines depend on the other series and differ from those of
+    compute_country by monte carlo noise; the weighted series and the fits
+    are the same. The results have the series along the first axis, except
+    kappas, p0s and run_parameters. They are held in memory, compute splits
+    many series into batches of batch_size.
+    """
+
+    if shared_samples:
+        raise ValueError("shared_samples is not supported in batches")
+
+    ts_reported_cases, ts_infection_activity, ts_infection_potential = (
+        get_weighted_series(ts_cumulative, inv_weights, fwd_weights)
+    )
+
+    kappas = np.flip(np.logspace(k_range[0], k_range[1], num=k_samp))
+
+    pvals, r_eff_case, r_eff_fits = get_pvals_batch(
+        ts_infection_potential,
+        ts_infection_activity,
+        kappas,
+        tau[0],
+        tau[1],
+        n,
+        distribution,
+        mode=mode,
+        rng=rng,
+        threads=threads,
+        crn=crn,
+        dtype=dtype,
+        pvalue_method=pvalue_method,
+        backend=backend,
+    )
+    with profile_stage("level_set_lines"):
+        kappa_levels = compute_level_set_lines_batch(
+            pvals, kappas, p0s, backend=backend
         )
 
-        p0s = [0.8, 0.85, 0.9, 0.95]
-        kappa_levels = compute_level_set_lines(pvals, kappas, p0s)
-
-        save_dict = {
-            "pvals": pvals,
-            "dates": ts_dates,
-            "reported_cases": ts_reported_cases,
-            "infectious_load": ts_infection_potential,
-            "infectious_activity": ts_infection_activity,
-            "kappas": kappas,
-            "r_eff_case": r_eff_case,
-            "r_eff_fits": r_eff_fits,
-            "kappa_level_set_lines": kappa_levels,
-            "p0s": p0s,
+    return {
+        "pvals": pvals,
+        "reported_cases": ts_reported_cases,
+        "infectious_load": ts_infection_potential,
+        "infectious_activity": ts_infection_activity,
+        "kappas": kappas,
+        "r_eff_case": r_eff_case,
+        "r_eff_fits": r_eff_fits,
+        "kappa_level_set_lines": kappa_levels,
+        "p0s": p0s,
+        "run_parameters": get_run_parameters(
+            mode=mode,
+            tau=tau,
+            distribution=distribution,
+            n=n,
+            crn=crn,
+            dtype=dtype,
+            shared_samples=False,
+            pvalue_method=pvalue_method,
+            kappa_search="dense",
+        ),
+    }
+
+
+def get_run_parameters(**params):
+    """the parameters of a run that the saved results depend on, as json in
+    an array of one string so that they can be saved with the results"""
+
+    return np.array([json.dumps(params, sort_keys=True)])
+
+
+def get_first_changed_day(previous,
+                          ts_infection_potential,
+                          ts_infection_activity,
+                          kappas,
+                          p0s,
+                          tau,
+                          with_pvals,
+                          run_parameters):
+    """first day whose results have to be recomputed, 0 if the previous
+    results were computed with a different setup
+
+    run_parameters are the parameters of get_run_parameters of the current
+    run; results without them, from earlier versions, are recomputed.
+    """
+
+    n_previous = len(previous["infectious_load"])
+    if (
+        "run_parameters" not in previous
+        or str(previous["run_parameters"][0]) != run_parameters[0]
+        or n_previous > len(ts_infection_potential)
+        or not np.array_equal(previous["kappas"], kappas)
+        or not np.array_equal(previous["p0s"], p0s)
+        or previous["r_eff_fits"].shape[1] != tau[0] + tau[1] + 1
+        or with_pvals != ("pvals" in previous)
+    ):
+        return 0
+
+    # the fitting window of day k covers the days k - tau1, ..., k + tau2;
+    # the round-off of the fft convolution depends on the length of the
+    # series, so the loads are compared up to a relative tolerance
+    changed = np.nonzero(
+        ~np.isclose(previous["infectious_load"], ts_infection_potential[:n_previous],
+                    rtol=1e-9, atol=0)
+        | ~np.isclose(previous["infectious_activity"],
+                      ts_infection_activity[:n_previous], rtol=1e-9, atol=0)
+    )[0]
+    first_changed = changed[0] if changed.size > 0 else n_previous
+    return max(0, first_changed - tau[1])
+
+
+# state shared by all countries computed in one process
+_worker_state = {}
+
+
+def _init_worker(data_dict, weights, params, options, progress=None, weighted=None):
+    _worker_state["data_dict"] = data_dict
+    _worker_state["weighted"] = {} if weighted is None else weighted
+    _worker_state["weights"] = weights
+    _worker_state["params"] = params
+    _worker_state["options"] = options
+    if progress is not None and not callable(progress):
+        # a worker process sends its events to the queue progress
+        queue = progress
+        progress = lambda *event: queue.put(event)
+    _worker_state["progress"] = progress
+
+
+def _compute_and_save(country, seed):
+    options = _worker_state["options"]
+    progress = _worker_state["progress"]
+    if progress is not None:
+        progress("country_start", country)
+
+    if not options["profile"]:
+        result = _compute_and_save_country(country, seed)
+    else:
+        start_profile(cprofile=options["cprofile"])
+        try:
+            result = _compute_and_save_country(country, seed)
+        finally:
+            report, cprofile = stop_profile()
+        mode = _worker_state["params"]["mode"]
+        _save_profile(_get_report_dir(country, mode, options["store"]),
+                      country, mode, report, cprofile)
+
+    if progress is not None:
+        progress("country_done", country)
+    return result
+
+
+def _compute_and_save_country(country, seed):
+    data_dict = _worker_state["data_dict"]
+    weights = _worker_state["weights"]
+    params = _worker_state["params"]
+    options = _worker_state["options"]
+
+    results_dir = get_results_dir(country, params["mode"])
+
+    if options["cache_dir"] is not None:
+        # the number of threads and the backend do not change the results;
+        # without a seed any earlier realization of the monte carlo sampling
+        # is reused
+        key_params = {
+            k: v for k, v in params.items() if k not in ["threads", "backend"]
         }
+        key_params["format"] = options["format"]
+        key_params["accuracy_report"] = options["accuracy_report"]
+        if options["seeded"]:
+            key_params["seed"] = [seed.entropy, seed.spawn_key]
+        cache_key = get_cache_key(
+            [data_dict[country], data_dict["dates"]]
+            + [array for w in (weights["inv"], weights["fwd"]) for array in w],
+            key_params,
+        )
+        with profile_stage("cache"):
+            if options["store"] is not None:
+                entry = get_cache_entry(options["cache_dir"], cache_key)
+                if entry is not None:
+                    profile_count("cache_hits")
+                    return load_data(entry, mmap=False)
+            elif restore_from_cache(options["cache_dir"], cache_key, results_dir):
+                profile_count("cache_hits")
+                return
+
+    previous = None
+    with profile_stage("load_previous"):
+        if options["incremental"] and options["store"] is not None:
+            previous = read_store(options["store"], [country], [params["mode"]])
+            previous = previous.get((country, params["mode"]))
+        elif options["incremental"] and has_data(results_dir):
+            previous = load_data(results_dir)
+    if previous is not None:
+        n_previous = len(previous["dates"])
+        if not np.array_equal(previous["dates"], data_dict["dates"][:n_previous]):
+            previous = None
+
+    # for the accuracy report the variates are drawn in float64 and rounded,
+    # so that the results and the float64 reference use the same random
+    # numbers and differ only by the rounding of the reduced precision
+    variates_dtype = None
+    if options["accuracy_report"]:
+        variates_dtype = "float64"
+
+    with profile_stage("compute"):
+        results = compute_country(
+            data_dict[country],
+            weights["inv"],
+            weights["fwd"],
+            rng=np.random.default_rng(seed),
+            previous=previous,
+            progress=_get_chunk_progress(_worker_state["progress"], country),
+            weighted=_worker_state["weighted"].get(country),
+            variates_dtype=variates_dtype,
+            **params
+        )
+
+    save_dict = {}
+    if "pvals" in results:
+        save_dict["pvals"] = results.pop("pvals")
+    save_dict["dates"] = data_dict["dates"]
+    save_dict.update(results)
+
+    if options["accuracy_report"] and params["dtype"] != "float64":
+        # the reference uses the same random numbers as the results
+        with profile_stage("accuracy_report"):
+            reference = compute_country(
+                data_dict[country],
+                weights["inv"],
+                weights["fwd"],
+                rng=np.random.default_rng(seed),
+                weighted=_worker_state["weighted"].get(country),
+                **dict(params, dtype="float64")
+            )
+            _save_accuracy_report(
+                _get_report_dir(country, params["mode"], options["store"]),
+                save_dict,
+                reference,
+                params,
+            )
+
+    # results that reuse days of previous results are not what the key
+    # describes, a run without incremental would get other p-values
+    cacheable = options["cache_dir"] is not None and previous is None
+
+    if options["store"] is not None:
+        # the results are returned to the process that writes the store
+        if cacheable:
+            with profile_stage("save"):
+                tmp_dir = tempfile.mkdtemp()
+                save_data(tmp_dir, save_dict, format=options["format"])
+                store_in_cache(
+                    options["cache_dir"], cache_key, tmp_dir, options["cache_size"]
+                )
+                shutil.rmtree(tmp_dir)
+        return save_dict
+
+    with profile_stage("save"):
+        save_data(results_dir, save_dict, format=options["format"])
+
+        if cacheable:
+            store_in_cache(
+                options["cache_dir"], cache_key, results_dir, options["cache_size"]
+            )
+
+
+def _save_accuracy_report(results_dir, results, reference, params):
+    report = {"dtype": params["dtype"]}
+    report.update(get_accuracy_report(results, reference, params["n"]))
+    if not os.path.exists(results_dir):
+        os.makedirs(results_dir)
+    with open(results_dir + "/accuracy.json", "w") as f:
+        json.dump(report, f, indent=2)
+
+
+def _get_progress(format, countries, n_days, params):
+    # the work of a country is counted in days times evaluated kappas
+    if format == "none":
+        return None
+    if params["kappa_search"] == "adaptive" and not params["full_pvals"]:
+        # an upper bound of the bisection steps
+        steps = int(np.ceil(np.log2(params["k_samp"] + 1)))
+        kappas_per_day = len(params["p0s"]) * steps
+    else:
+        kappas_per_day = params["k_samp"]
+    return get_progress_tracker(
+        countries, n_days * kappas_per_day, get_progress_handler(format)
+    )
+
+
+def _get_chunk_progress(progress, country):
+    if progress is None:
+        return None
+    return lambda work: progress("chunk", country, work)
+
+
+def _save_profile(results_dir, country, mode, report, cprofile):
+    if not os.path.exists(results_dir):
+        os.makedirs(results_dir)
+    with open(results_dir + "/profile.json", "w") as f:
+        json.dump(dict({"country": country, "mode": mode}, **report), f, indent=2)
+    if cprofile is not None:
+        cprofile.dump_stats(results_dir + "/profile.pstats")
+
 
-        country_str = country.replace(" ", "").replace(",", "").lower()
-        save_data("results/" + country_str + "_" + mode, save_dict)
+def _get_report_dir(country, mode, store):
+    # with a store the profiles and accuracy reports are kept in it, next to
+    # the results they describe
+    if store is None:
+        return get_results_dir(country, mode)
+    return store + "/reports/" + os.path.basename(get_results_dir(country, mode))
 
 
+def _save_to_store(store, country, mode, save_dict):
+    if store is not None:
+        append_to_store(store, country, mode, save_dict)
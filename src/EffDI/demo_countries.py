@@ -41,13 +41,14 @@ def demo_countries(countries=None,
             # load data
             country_dir_label = country.replace(" ", "").replace(",", "").lower()
             data = load_data("./results/" + country_dir_label + "_" + mode)
+            idx_p0 = get_level_set_index(data["p0s"])
 
             plot_country_incid_kappa_line(
                 axes[idx],
                 data["dates"],
                 data["reported_cases"],
-                data["kappa_level_set_lines"][2],
-                data["p0s"][2],
+                data["kappa_level_set_lines"][idx_p0],
+                data["p0s"][idx_p0],
                 countries[idx],
                 dates,
                 idx=idx,
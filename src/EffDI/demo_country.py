@@ -45,6 +45,12 @@ def demo_country(country_arg="Austria",
 
     # load data
     data = load_data("./results/" + country + "_" + mode)
+    if "pvals" not in data:
+        # --kappa-search adaptive only saves the level set lines
+        raise ValueError(
+            "the results of " + country_arg + " have no p-values, rerun compute "
+            "with --full-pvals"
+        )
 
     # fontsizes
     fontsize_label = 12
@@ -112,8 +118,11 @@ def demo_country(country_arg="Austria",
     # date in the reported cases ts
     omit_data_parameter = 20
 
+    # level set line for p0 = 0.9
+    idx_p0 = get_level_set_index(data["p0s"])
+
     # get dates where reported cases is non-zero
-    idxs_nonzero = np.nonzero(data["kappa_level_set_lines"][2])
+    idxs_nonzero = np.nonzero(data["kappa_level_set_lines"][idx_p0])
     kappa_dates = (data["dates"][idxs_nonzero]).min(), (
         data["dates"][idxs_nonzero]
     ).max()
@@ -123,9 +132,9 @@ def demo_country(country_arg="Austria",
         data["dates"],
         data["pvals"],
         data["kappas"],
-        data["kappa_level_set_lines"][2],
+        data["kappa_level_set_lines"][idx_p0],
         data["r_eff_case"],
-        data["p0s"][2],
+        data["p0s"][idx_p0],
         kappa_dates,
         omit_data_parameter,
         ZORDER_DEFAULT,
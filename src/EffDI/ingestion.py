@@ -0,0 +1,224 @@
+import hashlib
+import json
+import os
+
+import numpy as np
+import pandas as pd
+
+CACHE_VERSION = 1
+
+LABEL_COLUMNS = ["Province/State", "Country/Region", "Lat", "Long"]
+
+
+def load_data_matrix(filename, cache=True):
+    """rows of a wide time series csv file as a (rows x days) matrix
+
+    Returns a dict with the matrix "values", the labels "country" and
+    "province" of its rows and the "dates" of its columns. With cache the
+    parsed file is stored as .npy files in the directory filename + ".cache"
+    and reused as long as the file is unchanged; the values are then memory
+    mapped instead of read.
+    """
+
+    if not cache:
+        return _parse_csv(filename)
+
+    cache_dir = filename + ".cache"
+    stat = os.stat(filename)
+    meta = _read_cache_meta(cache_dir)
+    if meta is not None and (meta["mtime"], meta["size"]) != (
+        stat.st_mtime,
+        stat.st_size,
+    ):
+        # the file was touched, it is only reparsed if its content changed
+        if meta["size"] == stat.st_size and meta["sha256"] == _file_hash(filename):
+            meta.update({"mtime": stat.st_mtime})
+            _write_cache_meta(cache_dir, meta)
+        else:
+            meta = None
+
+    if meta is not None:
+        try:
+            return {
+                "values": np.load(cache_dir + "/values.npy", mmap_mode="r"),
+                "country": np.load(cache_dir + "/country.npy"),
+                "province": np.load(cache_dir + "/province.npy"),
+                "dates": np.load(cache_dir + "/dates.npy"),
+            }
+        except (OSError, ValueError):
+            pass
+
+    matrix = _parse_csv(filename)
+    try:
+        os.makedirs(cache_dir, exist_ok=True)
+        if os.path.exists(cache_dir + "/meta.json"):
+            os.remove(cache_dir + "/meta.json")
+        for key, value in matrix.items():
+            _save_npy(cache_dir + "/" + key + ".npy", value)
+        _write_cache_meta(
+            cache_dir,
+            {
+                "version": CACHE_VERSION,
+                "mtime": stat.st_mtime,
+                "size": stat.st_size,
+                "sha256": _file_hash(filename),
+            },
+        )
+    except OSError:
+        # e.g. a read-only data directory, the file is parsed on every call
+        pass
+    return matrix
+
+
+def iter_series(filename, countries=None, cache=True, grouping="country"):
+    """yield the summed series of the groups one at a time
+
+    With the cache the values are memory mapped, so only the rows of the
+    current group are read.
+    """
+
+    matrix = load_data_matrix(filename, cache=cache)
+    return iter_groups(matrix, countries, grouping)
+
+
+def iter_groups(matrix, countries=None, grouping="country"):
+    """iter_series of a matrix from load_data_matrix"""
+
+    names, membership = get_group_membership(matrix, grouping)
+    index = {name: k for k, name in enumerate(names)}
+
+    for country in names if countries is None else countries:
+        k = index[country]
+        members = slice(membership.indptr[k], membership.indptr[k + 1])
+        rows = membership.indices[members]
+        values = np.dot(membership.data[members], matrix["values"][rows])
+        yield country, values.astype(np.float32)
+
+
+def aggregate_groups(matrix, grouping="country"):
+    """names of the groups and the (groups x days) matrix of their summed
+    series, see get_group_membership"""
+
+    names, membership = get_group_membership(matrix, grouping)
+    values = membership @ np.asarray(matrix["values"], dtype=np.float64)
+    return names, values.astype(np.float32)
+
+
+def get_group_membership(matrix, grouping="country"):
+    """names of the groups and the sparse (groups x rows) matrix that sums
+    the rows of load_data_matrix to the groups
+
+    grouping is "country" to sum the provinces of every country, "province"
+    for every row on its own, named "<province>, <country>" or by the country
+    for rows without province, or a dict that maps the name of a custom group
+    to its members, which are countries or "<province>, <country>" names.
+    """
+
+    from scipy.sparse import csr_matrix
+
+    country = np.asarray(matrix["country"], dtype=str)
+    province = np.asarray(matrix["province"], dtype=str)
+    n_rows = len(country)
+
+    if grouping == "country":
+        names, rows = np.unique(country, return_inverse=True)
+        names = [str(name) for name in names]
+        group_idxs, row_idxs = rows, np.arange(n_rows)
+    elif grouping == "province":
+        names = get_row_names(matrix)
+        group_idxs, row_idxs = np.arange(n_rows), np.arange(n_rows)
+    elif isinstance(grouping, dict):
+        country_rows = {}
+        for row, name in enumerate(country):
+            country_rows.setdefault(name, []).append(row)
+        row_index = {name: row for row, name in enumerate(get_row_names(matrix))}
+
+        names = list(grouping)
+        group_idxs, row_idxs = [], []
+        for k, name in enumerate(names):
+            rows = set()
+            for member in grouping[name]:
+                if member in country_rows:
+                    rows.update(country_rows[member])
+                elif member in row_index:
+                    rows.add(row_index[member])
+                else:
+                    raise KeyError("unknown member " + repr(member))
+            group_idxs += [k] * len(rows)
+            row_idxs += sorted(rows)
+    else:
+        raise ValueError("unknown grouping")
+
+    membership = csr_matrix(
+        (np.ones(len(row_idxs)), (group_idxs, row_idxs)),
+        shape=(len(names), n_rows),
+    )
+    return names, membership
+
+
+def get_row_names(matrix):
+    """names of the rows, "<province>, <country>" or the country for rows
+    without province"""
+
+    return [
+        country if province == "" else province + ", " + country
+        for country, province in zip(
+            matrix["country"].tolist(), matrix["province"].tolist()
+        )
+    ]
+
+
+def load_grouping(filename):
+    """custom groups from a json file that maps group names to lists of
+    members"""
+
+    with open(filename) as f:
+        grouping = json.load(f)
+    if not isinstance(grouping, dict) or not all(
+        isinstance(members, list) for members in grouping.values()
+    ):
+        raise ValueError("a grouping maps group names to lists of members")
+    return grouping
+
+
+def _parse_csv(filename):
+    data = pd.read_csv(filename)
+    date_columns = data.columns.drop(LABEL_COLUMNS)
+    return {
+        "values": data[date_columns].to_numpy(np.float64),
+        "country": data["Country/Region"].to_numpy(str),
+        "province": data["Province/State"].fillna("").to_numpy(str),
+        "dates": pd.to_datetime(date_columns).to_numpy("datetime64[D]"),
+    }
+
+
+def _file_hash(filename):
+    h = hashlib.sha256()
+    with open(filename, "rb") as f:
+        for block in iter(lambda: f.read(2**20), b""):
+            h.update(block)
+    return h.hexdigest()
+
+
+def _read_cache_meta(cache_dir):
+    try:
+        with open(cache_dir + "/meta.json") as f:
+            meta = json.load(f)
+    except (OSError, ValueError):
+        return None
+    if meta.get("version") != CACHE_VERSION:
+        return None
+    return meta
+
+
+def _write_cache_meta(cache_dir, meta):
+    # the meta data is written last and atomically, it validates the cache
+    with open(cache_dir + "/meta.json.tmp", "w") as f:
+        json.dump(meta, f)
+    os.replace(cache_dir + "/meta.json.tmp", cache_dir + "/meta.json")
+
+
+def _save_npy(filename, array):
+    with open(filename + ".tmp", "wb") as f:
+        np.save(f, array)
+    os.replace(filename + ".tmp", filename)
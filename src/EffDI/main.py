@@ -1,9 +1,11 @@
 import argparse
 
+from EffDI.benchmark import *
 from EffDI.demo_country import *
 from EffDI.demo_countries import *
 from EffDI.compute import *
 from EffDI.pre_compute_weights import *
+from EffDI.sweep import *
 
 def main():
     parser = argparse.ArgumentParser()
@@ -27,29 +29,57 @@ def main():
         default="gamma",
         metavar="inv_distribution",
     )
+    parser_pcw.add_argument(
+        "--format",
+        type=str,
+        choices=["npz", "csv"],
+        help="binary weights files, which record the distribution, its "
+        "parameters and the window, or the csv files of earlier versions",
+        default="npz",
+    )
     #arguments for compute
     parser_c = subparsers.add_parser("compute")
     parser_c.add_argument(
         "--countries", nargs="*", type=str, help="countries", default=["Austria"]
     )
+    parser_c.add_argument(
+        "--all",
+        action="store_true",
+        help="compute all countries or groups of the data file",
+    )
+    parser_c.add_argument(
+        "--grouping",
+        type=str,
+        help="sum the series by country, use every province on its own "
+        "(named \"<province>, <country>\"), or give a json file that maps "
+        "group names to lists of countries and provinces",
+        default="country",
+    )
     parser_c.add_argument(
         "--data_file",
-        nargs=1,
         type=str,
         help=".csv file with daily incidence time series",
         default="time_series_covid19_confirmed_global.csv",
     )
+    parser_c.add_argument(
+        "--no-data-cache",
+        action="store_true",
+        help="always parse the .csv file instead of reusing the parsed data "
+        "stored next to it",
+    )
     parser_c.add_argument(
         "--inv_weights",
         type=str,
-        help="cvs file with inverse weights",
-        default="inv_weights.csv",
+        help=".npz or .csv file with inverse weights, or one of gamma, skewnorm "
+        "and delta to compute them in memory",
+        default="inv_weights.npz",
     )
     parser_c.add_argument(
         "--fwd_weights",
         type=str,
-        help="cvs file with forward weights",
-        default="fwd_weights.csv",
+        help=".npz or .csv file with forward weights, or one of gamma, skewnorm "
+        "and delta to compute them in memory",
+        default="fwd_weights.npz",
     )
     parser_c.add_argument(
         "--mode",
@@ -79,6 +109,171 @@ def main():
         help="distribution used to model secondary infections",
         default="gamma",
     )
+    parser_c.add_argument(
+        "--p0s",
+        nargs="*",
+        type=float,
+        help="levels of the p-value for the level set lines of kappa",
+        default=[0.8, 0.85, 0.9, 0.95],
+    )
+    parser_c.add_argument(
+        "--kappa-search",
+        type=str,
+        choices=["dense", "adaptive"],
+        help="evaluate the p-values on the full kappa grid or find the level "
+        "set lines by bisection on the grid",
+        default="dense",
+    )
+    parser_c.add_argument(
+        "--full-pvals",
+        action="store_true",
+        help="compute the full p-value matrix (needed by demo_country) also "
+        "with --kappa-search adaptive",
+    )
+    parser_c.add_argument(
+        "--crn",
+        action="store_true",
+        help="use common random numbers for all kappas",
+    )
+    parser_c.add_argument(
+        "--incremental",
+        action="store_true",
+        help="only recompute the days affected by new or changed data in "
+        "existing results",
+    )
+    parser_c.add_argument(
+        "--cache-dir",
+        type=str,
+        help="directory of a cache of results keyed on the input data and all "
+        "parameters; results that reuse days with --incremental are not cached",
+        default=None,
+    )
+    parser_c.add_argument(
+        "--cache-size",
+        type=int,
+        help="size limit of the cache in MB, least recently used results are "
+        "evicted",
+        default=1024,
+    )
+    parser_c.add_argument(
+        "--format",
+        type=str,
+        choices=["npz", "npy"],
+        help="save the results compressed in pvals.npz or as one .npy file "
+        "per variable, which is loaded memory mapped",
+        default="npz",
+    )
+    parser_c.add_argument(
+        "--store",
+        type=str,
+        help="directory of a consolidated store for the results of all "
+        "countries and modes, instead of results/<country>_<mode>; profiles "
+        "and accuracy reports are saved in <store>/reports/<country>_<mode>",
+        default=None,
+    )
+    parser_c.add_argument(
+        "--stream",
+        action="store_true",
+        help="process the countries one at a time and write the p-values to "
+        "disk while they are computed (implies --format npy); with "
+        "--no-data-cache the parsed data file is kept in memory",
+    )
+    parser_c.add_argument(
+        "--dtype",
+        type=str,
+        choices=["float64", "float32"],
+        help="precision of the monte carlo sampling and of the stored "
+        "p-values, the fits of the effective reproduction number are always "
+        "float64",
+        default="float64",
+    )
+    parser_c.add_argument(
+        "--accuracy-report",
+        action="store_true",
+        help="recompute every country in float64 with the same random numbers "
+        "and save the deviation of the results in accuracy.json (requires "
+        "--dtype float32); the random numbers are drawn in float64 and "
+        "rounded, so the results differ from a run without the report",
+    )
+    parser_c.add_argument(
+        "--shared-samples",
+        action="store_true",
+        help="draw the gamma samples once per kappa and day and share them "
+        "between the overlapping windows; faster, but the p-values of "
+        "neighbouring days are correlated",
+    )
+    parser_c.add_argument(
+        "--pvalue-method",
+        type=str,
+        choices=["sampling", "analytic"],
+        help="monte carlo p-values, or a moment matched approximation that "
+        "falls back to sampling where the model is too skewed; its p-values "
+        "are off by up to a few hundredths where a few days dominate a window",
+        default="sampling",
+    )
+    parser_c.add_argument(
+        "--backend",
+        type=str,
+        choices=["numpy", "numba"],
+        help="kernels of the inner loops; numba falls back to numpy if it is "
+        "not installed",
+        default="numpy",
+    )
+    parser_c.add_argument(
+        "--profile",
+        action="store_true",
+        help="save the wall and cpu time of the stages, the number of random "
+        "draws and least squares windows and the peak memory of every "
+        "country in profile.json next to its results",
+    )
+    parser_c.add_argument(
+        "--cprofile",
+        action="store_true",
+        help="like --profile and save the cProfile statistics of every "
+        "country in profile.pstats",
+    )
+    parser_c.add_argument(
+        "--progress",
+        type=str,
+        choices=["none", "text", "json"],
+        help="report the progress per country and kappa on stderr as text or "
+        "as one json object per line, with throughput and eta",
+        default="none",
+    )
+    parser_c.add_argument(
+        "--batch",
+        action="store_true",
+        help="compute the countries in batches with the fits and the sampling "
+        "vectorized over the countries, faster for many short series; the "
+        "countries of a batch share the random numbers, so the p-values depend "
+        "on which countries are in a batch and on --batch_size, and differ from "
+        "those without --batch by monte carlo noise",
+    )
+    parser_c.add_argument(
+        "--batch_size",
+        type=int,
+        help="number of countries per batch with --batch, bounds the memory "
+        "of the dense p-values and of --crn",
+        default=256,
+    )
+    parser_c.add_argument(
+        "--workers",
+        type=int,
+        help="number of processes, countries are distributed among them",
+        default=1,
+    )
+    parser_c.add_argument(
+        "--threads",
+        type=int,
+        help="number of threads per country, kappas are distributed among them",
+        default=1,
+    )
+    parser_c.add_argument(
+        "--seed",
+        type=int,
+        help="seed of the random number generator",
+        default=None,
+    )
     #arguments for demo_country
     parser_dc = subparsers.add_parser("demo_country")
     parser_dc.add_argument(
@@ -146,23 +341,288 @@ def main():
         default=None,
     )
 
+    #arguments for benchmark
+    parser_b = subparsers.add_parser("benchmark")
+    parser_b.add_argument(
+        "--n-days", type=int, help="length of the synthetic series", default=400
+    )
+    parser_b.add_argument(
+        "--level", type=float, help="initial daily incidence", default=1000
+    )
+    parser_b.add_argument(
+        "--kappa",
+        type=float,
+        help="dispersion of the synthetic series, smaller is more overdispersed",
+        default=10,
+    )
+    parser_b.add_argument(
+        "--distribution",
+        type=str,
+        choices=["gamma", "NB"],
+        help="model of the synthetic series and of the p-values",
+        default="gamma",
+    )
+    parser_b.add_argument(
+        "--countries",
+        type=int,
+        help="number of series in the synthetic data file",
+        default=1,
+    )
+    parser_b.add_argument(
+        "--mode",
+        type=str,
+        choices=["c", "t", "st"],
+        help="model of r_eff",
+        default="st",
+    )
+    parser_b.add_argument(
+        "--k_samp", type=int, help="samples of k in logarithmic scale", default=300
+    )
+    parser_b.add_argument(
+        "--n", type=int, help="number of sample for model", default=500
+    )
+    parser_b.add_argument(
+        "--repeat", type=int, help="number of runs of every stage", default=3
+    )
+    parser_b.add_argument(
+        "--seed", type=int, help="seed of the synthetic data and sampling", default=0
+    )
+    parser_b.add_argument(
+        "--output",
+        type=str,
+        help="json file for the results, printed if not given",
+        default=None,
+    )
+
+    #arguments for sweep
+    parser_s = subparsers.add_parser("sweep")
+    parser_s.add_argument(
+        "--taus",
+        nargs="+",
+        type=lambda s: [int(t) for t in s.split(",")],
+        help="pairs tau1,tau2 of the grid",
+        default=[[6, 7]],
+    )
+    parser_s.add_argument(
+        "--modes",
+        nargs="+",
+        type=str,
+        choices=["c", "t", "st"],
+        help="modes of the grid",
+        default=["st"],
+    )
+    parser_s.add_argument(
+        "--distributions",
+        nargs="+",
+        type=str,
+        choices=["gamma", "NB"],
+        help="distributions of the secondary infections of the grid",
+        default=["gamma"],
+    )
+    parser_s.add_argument(
+        "--gamma-means",
+        nargs="+",
+        type=float,
+        help="means of the gamma inverse weights of the grid",
+        default=[WEIGHT_PARAMETERS["gamma"]["mean"]],
+    )
+    parser_s.add_argument(
+        "--gamma-stds",
+        nargs="+",
+        type=float,
+        help="standard deviations of the gamma inverse weights of the grid",
+        default=[WEIGHT_PARAMETERS["gamma"]["std"]],
+    )
+    parser_s.add_argument(
+        "--countries", nargs="*", type=str, help="countries", default=["Austria"]
+    )
+    parser_s.add_argument(
+        "--all",
+        action="store_true",
+        help="compute all countries or groups of the data file",
+    )
+    parser_s.add_argument(
+        "--grouping",
+        type=str,
+        help="country, province or a json file with custom groups, see compute",
+        default="country",
+    )
+    parser_s.add_argument(
+        "--data_file",
+        type=str,
+        help=".csv file with daily incidence time series",
+        default="time_series_covid19_confirmed_global.csv",
+    )
+    parser_s.add_argument(
+        "--no-data-cache",
+        action="store_true",
+        help="always parse the .csv file",
+    )
+    parser_s.add_argument(
+        "--fwd_weights",
+        type=str,
+        help=".npz or .csv file with forward weights, or one of gamma, skewnorm "
+        "and delta",
+        default="fwd_weights.npz",
+    )
+    parser_s.add_argument(
+        "--k_range",
+        nargs=2,
+        type=int,
+        help="range of parameter k (logarithmic scale, base 10)",
+        default=[np.log10(0.1), 4],
+    )
+    parser_s.add_argument(
+        "--k_samp", type=int, help="samples of k in logarithmic scale", default=300
+    )
+    parser_s.add_argument("--n", type=int, help="number of sample for model", default=500)
+    parser_s.add_argument(
+        "--p0s",
+        nargs="*",
+        type=float,
+        help="levels of the p-value for the level set lines of kappa",
+        default=[0.8, 0.85, 0.9, 0.95],
+    )
+    parser_s.add_argument(
+        "--crn",
+        action="store_true",
+        help="use common random numbers for all kappas",
+    )
+    parser_s.add_argument(
+        "--dtype",
+        type=str,
+        choices=["float64", "float32"],
+        help="precision of the monte carlo sampling and of the stored p-values",
+        default="float64",
+    )
+    parser_s.add_argument(
+        "--pvalue-method",
+        type=str,
+        choices=["sampling", "analytic"],
+        help="monte carlo p-values or the moment matched approximation",
+        default="sampling",
+    )
+    parser_s.add_argument(
+        "--backend",
+        type=str,
+        choices=["numpy", "numba"],
+        help="kernels of the inner loops",
+        default="numpy",
+    )
+    parser_s.add_argument(
+        "--format",
+        type=str,
+        choices=["npz", "npy"],
+        help="format of the saved results",
+        default="npz",
+    )
+    parser_s.add_argument(
+        "--workers",
+        type=int,
+        help="number of processes, the p-values of the combinations and "
+        "countries are distributed among them",
+        default=1,
+    )
+    parser_s.add_argument(
+        "--threads",
+        type=int,
+        help="number of threads per country, kappas are distributed among them",
+        default=1,
+    )
+    parser_s.add_argument(
+        "--seed",
+        type=int,
+        help="seed of the random number generator",
+        default=None,
+    )
+    parser_s.add_argument(
+        "--output",
+        type=str,
+        help="directory of the results and of the index sweep.json",
+        default="sweep",
+    )
+
     args = parser.parse_args()
 
     if args.command == "pre_compute_weights":
         pre_compute_weights(fwd_distribution=args.fwd_distribution,
-                            inv_distribution=args.inv_distribution)
+                            inv_distribution=args.inv_distribution,
+                            format=args.format)
 
     if args.command == "compute":
         compute(data_file=args.data_file,
                 inv_weights=args.inv_weights,
                 fwd_weights=args.fwd_weights,
-                countries=args.countries,
+                countries=None if args.all else args.countries,
                 mode=args.mode,
                 tau=args.tau,
                 k_range=args.k_range,
                 k_samp=args.k_samp,
                 n=args.n,
-                distribution=args.distribution)
+                distribution=args.distribution,
+                workers=args.workers,
+                threads=args.threads,
+                seed=args.seed,
+                p0s=args.p0s,
+                kappa_search=args.kappa_search,
+                full_pvals=args.full_pvals,
+                crn=args.crn,
+                incremental=args.incremental,
+                cache_dir=args.cache_dir,
+                cache_size=args.cache_size,
+                data_cache=not args.no_data_cache,
+                format=args.format,
+                store=args.store,
+                stream=args.stream,
+                dtype=args.dtype,
+                accuracy_report=args.accuracy_report,
+                shared_samples=args.shared_samples,
+                pvalue_method=args.pvalue_method,
+                backend=args.backend,
+                profile=args.profile,
+                cprofile=args.cprofile,
+                progress=args.progress,
+                grouping=args.grouping,
+                batch=args.batch,
+                batch_size=args.batch_size)
+
+    if args.command == "sweep":
+        sweep(data_file=args.data_file,
+              fwd_weights=args.fwd_weights,
+              countries=None if args.all else args.countries,
+              grouping=args.grouping,
+              data_cache=not args.no_data_cache,
+              tau=args.taus,
+              mode=args.modes,
+              distribution=args.distributions,
+              gamma_mean=args.gamma_means,
+              gamma_std=args.gamma_stds,
+              k_range=args.k_range,
+              k_samp=args.k_samp,
+              n=args.n,
+              p0s=args.p0s,
+              crn=args.crn,
+              dtype=args.dtype,
+              pvalue_method=args.pvalue_method,
+              backend=args.backend,
+              format=args.format,
+              workers=args.workers,
+              threads=args.threads,
+              seed=args.seed,
+              output=args.output)
+
+    if args.command == "benchmark":
+        benchmark(output=args.output,
+                  n_days=args.n_days,
+                  level=args.level,
+                  kappa=args.kappa,
+                  distribution=args.distribution,
+                  n_countries=args.countries,
+                  mode=args.mode,
+                  k_samp=args.k_samp,
+                  n=args.n,
+                  repeat=args.repeat,
+                  seed=args.seed)
 
     if args.command == "demo_country":
         demo_country(country_arg=args.country,
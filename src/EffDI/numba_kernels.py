@@ -0,0 +1,61 @@
+import numba
+import numpy as np
+
+# compiled versions of the kernels in backends.py; they release the GIL, so
+# that the threads of get_pvals run in parallel
+
+
+@numba.njit(nogil=True, cache=True)
+def _window_exceedances(samples, means, test_statistic):
+    n_windows, n_samples, l = samples.shape
+    counts = np.zeros(n_windows, dtype=np.int64)
+    for i in range(n_windows):
+        for j in range(n_samples):
+            s = 0.0
+            for m in range(l):
+                d = samples[i, j, m] - means[i, m]
+                s += d * d
+            if s >= test_statistic[i]:
+                counts[i] += 1
+    return counts
+
+
+def window_exceedances(samples, means, test_statistic):
+    return _window_exceedances(samples, means, test_statistic)
+
+
+@numba.njit(nogil=True, cache=True)
+def _solve_windows(A, b):
+    coeffs = np.empty((A.shape[0], A.shape[2]))
+    for i in range(A.shape[0]):
+        coeffs[i] = np.dot(np.linalg.pinv(A[i]), b[i])
+    return coeffs
+
+
+def solve_windows(A, b):
+    return _solve_windows(
+        np.ascontiguousarray(A, dtype=np.float64),
+        np.ascontiguousarray(b, dtype=np.float64),
+    )
+
+
+@numba.njit(nogil=True, cache=True)
+def _level_set_lines(pvals, kappas, p0s):
+    n_kappas, n_days = pvals.shape
+    kappa_level = np.zeros((len(p0s), n_days))
+    for d in range(n_days):
+        for k in range(len(p0s)):
+            # nan p-values never exceed p0
+            for i in range(n_kappas):
+                if pvals[i, d] > p0s[k]:
+                    kappa_level[k, d] = kappas[i]
+                    break
+    return kappa_level
+
+
+def level_set_lines(pvals, kappas, p0s):
+    return _level_set_lines(
+        np.asarray(pvals),
+        np.asarray(kappas, dtype=np.float64),
+        np.asarray(p0s, dtype=np.float64),
+    )
@@ -1,7 +1,24 @@
+import functools
+import json
+import os
+
 import numpy as np
 
 import csv
 
+# version of the binary weights files, increased on incompatible changes
+WEIGHTS_VERSION = 1
+
+# parameters of the distributions of the serial interval
+WEIGHT_PARAMETERS = {
+    "delta": {},
+    "gamma": {"mean": 5.6, "std": 4.2},
+    "skewnorm": {"shape": 0.828, "loc": 2.045, "scale": 5.199},
+}
+
+# distributions that pre_compute_weights uses by default
+DEFAULT_WEIGHT_DISTRIBUTIONS = {"inv": "gamma", "fwd": "delta"}
+
 
 def get_inv_window(distribution):
     if distribution not in ["delta", "gamma", "skewnorm"]:
@@ -29,28 +46,53 @@ def get_fwd_window(distribution):
     return fwd_window_left, fwd_window_right
 
 
-def compute_fwd_weights(fwd_window_left, fwd_window_right, distribution):
+def compute_fwd_weights(
+    fwd_window_left, fwd_window_right, distribution, parameters=None
+):
     if distribution == "delta":
         return np.array([1.0])
     if distribution == "gamma":
-        return _discrete_gamma(np.arange(fwd_window_left, fwd_window_right + 1))
+        return _discrete_gamma(
+            np.arange(fwd_window_left, fwd_window_right + 1),
+            **get_weight_parameters("gamma", parameters)
+        )
     if distribution == "skewnorm":
-        return _discrete_skewnorm(np.arange(fwd_window_left, fwd_window_right + 1))
+        return _discrete_skewnorm(
+            np.arange(fwd_window_left, fwd_window_right + 1),
+            **get_weight_parameters("skewnorm", parameters)
+        )
 
 
-def compute_inv_weights(inv_window_left, inv_window_right, distribution):
+def compute_inv_weights(
+    inv_window_left, inv_window_right, distribution, parameters=None
+):
     if distribution == "delta":
         return np.array([1.0])
     if distribution == "gamma":
         return np.flip(
-            _discrete_gamma(np.arange(-inv_window_right, -inv_window_left + 1))
+            _discrete_gamma(
+                np.arange(-inv_window_right, -inv_window_left + 1),
+                **get_weight_parameters("gamma", parameters)
+            )
         )
     if distribution == "skewnorm":
         return np.flip(
-            _discrete_skewnorm(np.arange(inv_window_left, inv_window_right + 1))
+            _discrete_skewnorm(
+                np.arange(inv_window_left, inv_window_right + 1),
+                **get_weight_parameters("skewnorm", parameters)
+            )
         )
 
 
+def get_weight_parameters(distribution, parameters=None):
+    """WEIGHT_PARAMETERS of distribution updated with parameters"""
+
+    parameters = dict(WEIGHT_PARAMETERS[distribution], **(parameters or {}))
+    if len(parameters) > len(WEIGHT_PARAMETERS[distribution]):
+        raise ValueError("unknown parameters of the {} weights".format(distribution))
+    return parameters
+
+
 def _discrete_skewnorm(days, shape=0.828, loc=2.045, scale=5.199):
 
     from scipy.stats import skewnorm
@@ -79,26 +121,109 @@ def _discrete_gamma(days, mean=5.6, std=4.2):
     return pmf
 
 
-def pre_compute_weights(fwd_distribution="delta", inv_distribution="gamma"):
-
-    inv_window_left, inv_window_right = get_inv_window(inv_distribution)
-    fwd_window_left, fwd_window_right = get_fwd_window(fwd_distribution)
-
-    fwd_weights = compute_fwd_weights(
-        fwd_window_left, fwd_window_right, fwd_distribution
-    )
-    inv_weights = compute_inv_weights(
-        inv_window_left, inv_window_right, inv_distribution
-    )
-
-    f_inv_weights = open("inv_weights.csv", "w")
-    writer = csv.writer(f_inv_weights)
-    writer.writerow(np.arange(inv_window_left, inv_window_right + 1))
-    writer.writerow(inv_weights)
-
-    f_fwd_weights = open("fwd_weights.csv", "w")
-    writer = csv.writer(f_fwd_weights)
-    writer.writerow(np.arange(fwd_window_left, fwd_window_right + 1))
-    writer.writerow(fwd_weights)
+@functools.lru_cache(maxsize=None)
+def get_weights(kind, distribution, **parameters):
+    """(weights, window_left, window_right) of the inverse ("inv") or forward
+    ("fwd") weights of distribution, computed once per process; parameters
+    replace those of WEIGHT_PARAMETERS
 
+    The weights are read-only, as they are shared by all callers.
+    """
 
+    if kind == "inv":
+        window_left, window_right = get_inv_window(distribution)
+        weights = compute_inv_weights(
+            window_left, window_right, distribution, parameters
+        )
+    elif kind == "fwd":
+        window_left, window_right = get_fwd_window(distribution)
+        weights = compute_fwd_weights(
+            window_left, window_right, distribution, parameters
+        )
+    else:
+        raise ValueError("unknown kind of weights")
+    weights.flags.writeable = False
+    return weights, window_left, window_right
+
+
+def save_weights(filename, kind, distribution, **parameters):
+    """write the weights to filename in the binary format, which records the
+    version, the kind, the distribution, its parameters and the window
+
+    The file is written next to filename first and then moved into place, so
+    that readers never see a partially written file.
+    """
+
+    weights, window_left, window_right = get_weights(kind, distribution, **parameters)
+    with open(filename + ".tmp", "wb") as f:
+        np.savez(
+            f,
+            version=WEIGHTS_VERSION,
+            kind=kind,
+            distribution=distribution,
+            parameters=json.dumps(get_weight_parameters(distribution, parameters)),
+            window=[window_left, window_right],
+            weights=weights,
+        )
+    os.replace(filename + ".tmp", filename)
+
+
+def save_weights_csv(filename, kind, distribution):
+    """write the weights to filename in the csv format of earlier versions,
+    the window in the first row and the weights in the second"""
+
+    weights, window_left, window_right = get_weights(kind, distribution)
+    with open(filename + ".tmp", "w", newline="") as f:
+        writer = csv.writer(f)
+        writer.writerow(np.arange(window_left, window_right + 1))
+        writer.writerow(weights)
+    os.replace(filename + ".tmp", filename)
+
+
+def read_weights(filename, kind=None):
+    """(weights, window_left, window_right) from a binary (.npz) or csv
+    weights file; with kind the kind recorded in a binary file is checked"""
+
+    if not filename.endswith(".npz"):
+        return _read_weights_csv(filename)
+    with np.load(filename, allow_pickle=False) as f:
+        if int(f["version"]) > WEIGHTS_VERSION:
+            raise ValueError(
+                "{} has weights version {}, this version reads up to {}".format(
+                    filename, int(f["version"]), WEIGHTS_VERSION
+                )
+            )
+        if kind is not None and str(f["kind"]) != kind:
+            raise ValueError(
+                "{} contains {} weights, not {}".format(filename, f["kind"], kind)
+            )
+        window_left, window_right = (int(v) for v in f["window"])
+        return f["weights"], window_left, window_right
+
+
+def _read_weights_csv(filename):
+    weights_content = []
+    with open(filename) as csv_file:
+        csv_reader = csv.reader(csv_file, delimiter=",")
+        for row in csv_reader:
+            weights_content.append(np.array(row, dtype=float))
+
+    window_left = int(np.amin(weights_content[0]))
+    window_right = int(np.amax(weights_content[0]))
+    return weights_content[1], window_left, window_right
+
+
+def pre_compute_weights(
+    fwd_distribution="delta", inv_distribution="gamma", format="npz"
+):
+    """write the inverse and forward weights to inv_weights.<format> and
+    fwd_weights.<format>"""
+
+    if format == "npz":
+        save_weights("inv_weights.npz", "inv", inv_distribution)
+        save_weights("fwd_weights.npz", "fwd", fwd_distribution)
+    elif format == "csv":
+        save_weights_csv("inv_weights.csv", "inv", inv_distribution)
+        save_weights_csv("fwd_weights.csv", "fwd", fwd_distribution)
+    else:
+        raise ValueError("unknown weights format")
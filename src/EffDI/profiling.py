@@ -0,0 +1,105 @@
+import contextlib
+import threading
+import time
+import tracemalloc
+
+# profile of the current process, collected between start_profile and
+# stop_profile
+_profile = {"active": False}
+_lock = threading.Lock()
+
+
+def start_profile(cprofile=False):
+    """collect the times of the stages and the counters of this process
+
+    Peak memory is traced with tracemalloc, which slows down allocations
+    somewhat. With cprofile the calls of the current thread are profiled
+    with cProfile as well.
+    """
+
+    _profile.update(
+        {
+            "active": True,
+            "stages": {},
+            "counters": {},
+            "wall_time": time.perf_counter(),
+            "cpu_time": time.process_time(),
+            "cprofile": None,
+        }
+    )
+    # tracing that was started by someone else is left running
+    _profile["tracemalloc"] = not tracemalloc.is_tracing()
+    if _profile["tracemalloc"]:
+        tracemalloc.start()
+    tracemalloc.reset_peak()
+    if cprofile:
+        import cProfile
+
+        _profile["cprofile"] = cProfile.Profile()
+        _profile["cprofile"].enable()
+
+
+def stop_profile():
+    """stop collecting and return the profile as a dict and the
+    cProfile.Profile, which is None without cprofile"""
+
+    if _profile["cprofile"] is not None:
+        _profile["cprofile"].disable()
+    _profile["active"] = False
+    peak = tracemalloc.get_traced_memory()[1]
+    if _profile["tracemalloc"]:
+        tracemalloc.stop()
+
+    report = {
+        "wall_time": time.perf_counter() - _profile["wall_time"],
+        "cpu_time": time.process_time() - _profile["cpu_time"],
+        "peak_traced_memory": peak,
+        "max_rss": _get_max_rss(),
+        "stages": _profile["stages"],
+        "counters": _profile["counters"],
+    }
+    return report, _profile["cprofile"]
+
+
+@contextlib.contextmanager
+def profile_stage(name):
+    """add the wall and cpu time of the block to the stage name; the cpu
+    time includes all threads of the process"""
+
+    if not _profile["active"]:
+        yield
+        return
+    wall_time = time.perf_counter()
+    cpu_time = time.process_time()
+    try:
+        yield
+    finally:
+        wall_time = time.perf_counter() - wall_time
+        cpu_time = time.process_time() - cpu_time
+        with _lock:
+            stage = _profile["stages"].setdefault(
+                name, {"calls": 0, "wall_time": 0.0, "cpu_time": 0.0}
+            )
+            stage["calls"] += 1
+            stage["wall_time"] += wall_time
+            stage["cpu_time"] += cpu_time
+
+
+def profile_count(name, n=1):
+    """add n to the counter name"""
+
+    if _profile["active"]:
+        with _lock:
+            _profile["counters"][name] = _profile["counters"].get(name, 0) + int(n)
+
+
+def _get_max_rss():
+    # peak resident memory of the process in bytes; the resource module is
+    # not available on windows
+    try:
+        import resource
+        import sys
+    except ImportError:
+        return None
+    max_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return max_rss if sys.platform == "darwin" else max_rss * 1024
@@ -0,0 +1,123 @@
+import datetime
+import json
+import sys
+import threading
+import time
+
+PROGRESS_FORMATS = ["none", "text", "json"]
+
+
+def get_progress_tracker(countries, work_per_country, handler):
+    """function report(event, country=None, work=0) that accumulates the
+    progress of a run and passes every event to handler as a dict
+
+    The work is counted in days times kappas. The events are "run_start",
+    "country_start", "chunk" with the work done since the last chunk,
+    "country_done" and "run_done". The rate is the average over the run, the
+    eta assumes that the remaining countries need work_per_country each. The
+    tracker may be called from several threads.
+    """
+
+    total = len(countries) * work_per_country
+    index = {country: k for k, country in enumerate(countries)}
+    state = {
+        "start": time.perf_counter(),
+        "country_done": dict.fromkeys(countries, 0),
+        "done": 0,
+        "finished": 0,
+    }
+    lock = threading.Lock()
+
+    def report(event, country=None, work=0):
+        with lock:
+            if event == "chunk":
+                work = min(work, work_per_country - state["country_done"][country])
+            elif event == "country_done":
+                work = work_per_country - state["country_done"][country]
+                state["finished"] += 1
+            else:
+                work = 0
+            if country is not None:
+                state["country_done"][country] += work
+            state["done"] += work
+
+            elapsed = time.perf_counter() - state["start"]
+            rate = state["done"] / elapsed if elapsed > 0 else 0.0
+            remaining = total - state["done"]
+            handler(
+                {
+                    "event": event,
+                    "time": time.time(),
+                    "country": country,
+                    "country_index": None if country is None else index[country],
+                    "n_countries": len(countries),
+                    "finished": state["finished"],
+                    "done": state["done"],
+                    "total": total,
+                    "elapsed": elapsed,
+                    "rate": rate,
+                    "eta": remaining / rate if rate > 0 else None,
+                }
+            )
+
+    return report
+
+
+def get_progress_handler(format="text", file=None, interval=2.0):
+    """handler for the events of get_progress_tracker that writes them as
+    text or as one json object per line
+
+    chunk events are written at most every interval seconds, all other
+    events are always written.
+    """
+
+    if format not in PROGRESS_FORMATS:
+        raise ValueError("unknown progress format")
+    last = {"time": -float("inf")}
+
+    def handler(event):
+        if format == "none":
+            return
+        if event["event"] == "chunk":
+            now = time.perf_counter()
+            if now - last["time"] < interval:
+                return
+            last["time"] = now
+        f = sys.stderr if file is None else file
+        if format == "json":
+            f.write(json.dumps(event) + "\n")
+        else:
+            f.write(format_progress(event) + "\n")
+        f.flush()
+
+    return handler
+
+
+def format_progress(event):
+    """one line description of a progress event"""
+
+    fraction = event["done"] / event["total"] if event["total"] > 0 else 1.0
+    if event["eta"] is None:
+        eta = "?"
+    else:
+        eta = str(datetime.timedelta(seconds=round(event["eta"])))
+    if event["country"] is None:
+        prefix = event["event"].replace("_", " ")
+    else:
+        prefix = "{} ({}/{}) {}".format(
+            event["country"],
+            event["country_index"] + 1,
+            event["n_countries"],
+            event["event"].replace("country_", "").replace("chunk", "running"),
+        )
+    return "{}: {:.1%} done, {:.3g} day-kappas/s, eta {}".format(
+        prefix, fraction, event["rate"], eta
+    )
+
+
+def listen_progress(queue, report):
+    """pass the events put into queue by other processes to report until
+    None is put"""
+
+    for event in iter(queue.get, None):
+        report(*event)
@@ -0,0 +1,182 @@
+import json
+import os
+
+import numpy as np
+
+from EffDI.computation import DAY_AXES
+
+STORE_VERSION = 1
+
+
+def append_to_store(store_dir, country, mode, data):
+    """append the results of a country to a consolidated store
+
+    The store keeps one binary file per variable, in which the arrays of all
+    countries and modes are concatenated, and an index with the offset, shape
+    and dtype of every array. Appending a country that is already in the
+    store replaces its index entry; the old arrays remain in the files until
+    they take more space than the arrays of the entries, then the store is
+    compacted. The store must not be written by several processes at the
+    same time.
+    """
+
+    if not os.path.exists(store_dir):
+        os.makedirs(store_dir)
+    index = read_store_index(store_dir)
+
+    fields = {}
+    for key, value in data.items():
+        value = np.ascontiguousarray(value)
+        with open(_get_store_file(store_dir, index, key), "ab") as f:
+            offset = f.seek(0, os.SEEK_END)
+            f.write(value.tobytes())
+        fields[key] = {
+            "offset": offset,
+            "shape": list(value.shape),
+            "dtype": value.dtype.str,
+        }
+
+    entries = []
+    for entry in index["entries"]:
+        if (entry["country"], entry["mode"]) != (country, mode):
+            entries.append(entry)
+        else:
+            index["garbage"] = index.get("garbage", 0) + _get_entry_size(entry)
+    entries.append({"country": country, "mode": mode, "fields": fields})
+    index["entries"] = entries
+    _write_store_index(store_dir, index)
+
+    if index.get("garbage", 0) > sum(_get_entry_size(e) for e in entries):
+        compact_store(store_dir)
+
+
+def compact_store(store_dir):
+    """rewrite the files of the store with only the arrays of its entries,
+    which frees the space of replaced entries
+
+    The arrays are copied to files of a new generation, which the index
+    refers to once it is replaced, so readers see either the old or the new
+    files. The old files are removed afterwards; arrays that are still memory
+    mapped stay readable until they are closed.
+    """
+
+    index = read_store_index(store_dir)
+    compacted = {
+        "version": STORE_VERSION,
+        "generation": index.get("generation", 0) + 1,
+        "entries": [],
+    }
+    old_files = set()
+    for entry in index["entries"]:
+        fields = {}
+        for key, field in entry["fields"].items():
+            old_files.add(_get_store_file(store_dir, index, key))
+            value = _map_field(_get_store_file(store_dir, index, key), field)
+            with open(_get_store_file(store_dir, compacted, key), "ab") as f:
+                offset = f.seek(0, os.SEEK_END)
+                f.write(np.ascontiguousarray(value).tobytes())
+            fields[key] = dict(field, offset=offset)
+        compacted["entries"].append(dict(entry, fields=fields))
+    _write_store_index(store_dir, compacted)
+
+    for file in old_files:
+        if os.path.exists(file):
+            os.remove(file)
+
+
+def read_store_index(store_dir):
+    if not os.path.exists(store_dir + "/index.json"):
+        return {"version": STORE_VERSION, "entries": []}
+    with open(store_dir + "/index.json") as f:
+        index = json.load(f)
+    if index.get("version") != STORE_VERSION:
+        raise ValueError("unsupported store version")
+    return index
+
+
+def read_store(store_dir, countries=None, modes=None, fields=None):
+    """memory mapped arrays of the selected countries, modes and variables as
+    a dict with keys (country, mode)"""
+
+    data = {}
+    index = read_store_index(store_dir)
+    for entry in index["entries"]:
+        if countries is not None and entry["country"] not in countries:
+            continue
+        if modes is not None and entry["mode"] not in modes:
+            continue
+        data[(entry["country"], entry["mode"])] = {
+            key: _map_field(_get_store_file(store_dir, index, key), field)
+            for key, field in entry["fields"].items()
+            if fields is None or key in fields
+        }
+    return data
+
+
+def stack_store(store_dir, field, countries=None, mode="st"):
+    """stack a variable of several countries on a common date axis
+
+    Returns the union of the dates, the countries and an array with the
+    countries along the first axis; days where a country has no results are
+    nan. Variables that are not per day, e.g. kappas, are stacked as they are.
+    """
+
+    data = read_store(store_dir, countries, [mode], [field, "dates"])
+    if countries is None:
+        countries = [country for country, _ in data]
+    else:
+        countries = [country for country in countries if (country, mode) in data]
+    entries = [data[(country, mode)] for country in countries]
+    if not entries:
+        return np.zeros(0, dtype="datetime64[D]"), countries, np.zeros(0)
+
+    if field not in DAY_AXES:
+        return entries[0]["dates"], countries, np.stack([e[field] for e in entries])
+
+    dates = np.unique(np.concatenate([e["dates"] for e in entries]))
+    axis = DAY_AXES[field]
+    shape = list(np.delete(entries[0][field].shape, axis))
+    if entries[0][field].dtype.kind == "M":
+        stacked = np.full([len(entries), len(dates)] + shape, np.datetime64("NaT"))
+    else:
+        stacked = np.full([len(entries), len(dates)] + shape, np.nan)
+    for k, entry in enumerate(entries):
+        idxs = np.searchsorted(dates, entry["dates"])
+        stacked[k, idxs] = np.moveaxis(entry[field], axis, 0)
+    return dates, countries, np.moveaxis(stacked, 1, 1 + axis)
+
+
+def _write_store_index(store_dir, index):
+    # the index is replaced atomically, readers see either the old or the new
+    # entries
+    with open(store_dir + "/index.json.tmp", "w") as f:
+        json.dump(index, f)
+    os.replace(store_dir + "/index.json.tmp", store_dir + "/index.json")
+
+
+def _get_store_file(store_dir, index, key):
+    # the files of the first generation have no suffix
+    generation = index.get("generation", 0)
+    if generation == 0:
+        return store_dir + "/" + key + ".bin"
+    return "{}/{}.{}.bin".format(store_dir, key, generation)
+
+
+def _get_entry_size(entry):
+    return sum(
+        int(np.prod(field["shape"])) * np.dtype(field["dtype"]).itemsize
+        for field in entry["fields"].values()
+    )
+
+
+def _map_field(filename, field):
+    shape = tuple(field["shape"])
+    if 0 in shape:
+        return np.zeros(shape, dtype=field["dtype"])
+    return np.memmap(
+        filename,
+        dtype=field["dtype"],
+        mode="r",
+        offset=field["offset"],
+        shape=shape,
+    )
@@ -0,0 +1,328 @@
+from concurrent.futures import FIRST_COMPLETED, ProcessPoolExecutor, wait
+import itertools
+import json
+import os
+
+import numpy as np
+
+from EffDI.compute import *
+
+SWEEP_VERSION = 1
+
+# stages that are run by the worker processes, the others are cheap and run
+# in the main process
+SWEEP_PARALLEL_STAGES = ["pvals"]
+
+
+def get_sweep_combinations(
+    tau=[[6, 7]],
+    mode=["st"],
+    distribution=["gamma"],
+    gamma_mean=[WEIGHT_PARAMETERS["gamma"]["mean"]],
+    gamma_std=[WEIGHT_PARAMETERS["gamma"]["std"]],
+):
+    """all combinations of the parameter grid as dicts; gamma_mean and
+    gamma_std are the parameters of the gamma inverse weights"""
+
+    return [
+        {
+            "tau": [int(t) for t in t_pair],
+            "mode": m,
+            "distribution": d,
+            "gamma_mean": float(mean),
+            "gamma_std": float(std),
+        }
+        for t_pair, m, d, mean, std in itertools.product(
+            tau, mode, distribution, gamma_mean, gamma_std
+        )
+    ]
+
+
+def get_sweep_name(combination):
+    return "tau{}-{}_{}_mean{}_std{}".format(
+        combination["tau"][0],
+        combination["tau"][1],
+        combination["distribution"],
+        combination["gamma_mean"],
+        combination["gamma_std"],
+    )
+
+
+def get_sweep_graph(combinations, countries):
+    """stages of a sweep as a dict of key: keys of the dependencies
+
+    The stages are ingest -> weights -> convolution -> r_eff -> pvals, the
+    key of a stage is its name followed by the parameters it depends on, so
+    combinations that agree in these parameters share the stage. pvals has
+    one stage per combination and country, which also computes the level
+    set lines and saves the results.
+    """
+
+    graph = {("ingest",): []}
+    for combination in combinations:
+        weights = ("weights", combination["gamma_mean"], combination["gamma_std"])
+        convolution = ("convolution",) + weights[1:]
+        fit = (tuple(combination["tau"]), combination["mode"])
+        r_eff = ("r_eff",) + convolution[1:] + fit
+        graph[weights] = []
+        graph[convolution] = [("ingest",), weights]
+        graph[r_eff] = [convolution]
+        for country in countries:
+            pvals = ("pvals",) + r_eff[1:] + (combination["distribution"], country)
+            graph[pvals] = [("ingest",), convolution, r_eff]
+    return graph
+
+
+def run_graph(graph, results, get_task, workers=1, parallel_stages=[]):
+    """run every stage of graph once its dependencies are in results
+
+    get_task(key, results) returns the function and the arguments of a
+    stage. With more than one worker the stages named in parallel_stages are
+    run by a process pool while the main process runs the others. The result
+    of a stage is released once all stages that depend on it are done, the
+    results of the final stages are kept in results.
+    """
+
+    n_dependents = dict.fromkeys(graph, 0)
+    for dependencies in graph.values():
+        for dependency in dependencies:
+            n_dependents[dependency] += 1
+    remaining = [key for key in graph if key not in results]
+
+    def finish(key, result):
+        results[key] = result
+        for dependency in graph[key]:
+            n_dependents[dependency] -= 1
+            if n_dependents[dependency] == 0:
+                del results[dependency]
+
+    executor = None
+    if workers > 1:
+        executor = ProcessPoolExecutor(max_workers=workers)
+    pending = {}
+    try:
+        while remaining or pending:
+            ready = [
+                key
+                for key in remaining
+                if all(dependency in results for dependency in graph[key])
+            ]
+            # the parallel stages are submitted first, so that the workers
+            # are busy while the main process runs the others
+            ready.sort(key=lambda key: key[0] not in parallel_stages)
+            for key in ready:
+                remaining.remove(key)
+                func, args = get_task(key, results)
+                if executor is not None and key[0] in parallel_stages:
+                    pending[executor.submit(func, *args)] = key
+                else:
+                    finish(key, func(*args))
+            if not ready:
+                if not pending:
+                    raise ValueError("the stages of the graph have a cycle")
+                done, _ = wait(pending, return_when=FIRST_COMPLETED)
+                for future in done:
+                    finish(pending.pop(future), future.result())
+    finally:
+        if executor is not None:
+            executor.shutdown(cancel_futures=True)
+    return results
+
+
+def sweep(
+    data_file="time_series_covid19_confirmed_global.csv",
+    fwd_weights="fwd_weights.npz",
+    countries=["Austria"],
+    grouping="country",
+    data_cache=True,
+    tau=[[6, 7]],
+    mode=["st"],
+    distribution=["gamma"],
+    gamma_mean=[WEIGHT_PARAMETERS["gamma"]["mean"]],
+    gamma_std=[WEIGHT_PARAMETERS["gamma"]["std"]],
+    k_range=[np.log10(0.1), 4],
+    k_samp=300,
+    n=500,
+    p0s=[0.8, 0.85, 0.9, 0.95],
+    crn=False,
+    dtype="float64",
+    pvalue_method="sampling",
+    backend="numpy",
+    format="npz",
+    workers=1,
+    threads=1,
+    seed=None,
+    output="sweep",
+):
+    """compute the countries for all combinations of the parameter grid
+
+    The data is read once, the inverse weights and the convolutions are
+    computed once per gamma_mean and gamma_std, and the fits of r_eff once
+    per weights, tau and mode; only the p-values are computed for every
+    combination, distributed among the workers. The results of a
+    combination are saved in <output>/<name>/<country>_<mode> and listed in
+    <output>/sweep.json. Every combination uses the random streams of
+    compute with the same seed, so it reproduces the results of compute,
+    and the differences between combinations are not blurred by monte
+    carlo noise.
+    """
+
+    if grouping not in ["country", "province"]:
+        grouping = load_grouping(os.path.expanduser(grouping))
+    data_dict = get_data_dict(
+        os.path.expanduser(data_file), cache=data_cache, grouping=grouping
+    )
+    if countries is None:
+        countries = [key for key in data_dict if key != "dates"]
+    countries = correct_space_in_input(data_dict, countries)
+
+    combinations = get_sweep_combinations(
+        tau, mode, distribution, gamma_mean, gamma_std
+    )
+    graph = get_sweep_graph(combinations, countries)
+    root_seed = np.random.SeedSequence(seed)
+    options = {
+        "fwd_weights": load_weights(fwd_weights, "fwd"),
+        "countries": countries,
+        "index": {country: k for k, country in enumerate(countries)},
+        "seeds": [get_country_seed(root_seed, country) for country in countries],
+        "params": {
+            "k_range": k_range,
+            "k_samp": k_samp,
+            "n": n,
+            "p0s": p0s,
+            "crn": crn,
+            "dtype": dtype,
+            "pvalue_method": pvalue_method,
+            "backend": resolve_backend(backend),
+            "threads": threads,
+        },
+        "format": format,
+        "output": output,
+    }
+
+    results = run_graph(
+        graph,
+        {("ingest",): data_dict},
+        lambda key, results: _get_sweep_task(key, results, options),
+        workers=workers,
+        parallel_stages=SWEEP_PARALLEL_STAGES,
+    )
+
+    index = {
+        "version": SWEEP_VERSION,
+        "stages": {},
+        "params": dict(
+            options["params"],
+            data_file=data_file,
+            fwd_weights=fwd_weights,
+            grouping=grouping,
+            seed=seed,
+        ),
+        "combinations": [],
+    }
+    for key in graph:
+        index["stages"][key[0]] = index["stages"].get(key[0], 0) + 1
+    for combination in combinations:
+        r_eff = (
+            combination["gamma_mean"],
+            combination["gamma_std"],
+            tuple(combination["tau"]),
+            combination["mode"],
+        )
+        index["combinations"].append(
+            {
+                "name": get_sweep_name(combination),
+                "parameters": combination,
+                "results": {
+                    country: results[
+                        ("pvals",) + r_eff + (combination["distribution"], country)
+                    ]
+                    for country in countries
+                },
+            }
+        )
+    if not os.path.exists(output):
+        os.makedirs(output)
+    with open(output + "/sweep.json.tmp", "w") as f:
+        json.dump(index, f, indent=2)
+    os.replace(output + "/sweep.json.tmp", output + "/sweep.json")
+    return index
+
+
+def _get_sweep_task(key, results, options):
+    stage = key[0]
+    if stage == "weights":
+        return _get_inv_weights, key[1:]
+    if stage == "convolution":
+        data_dict = results[("ingest",)]
+        countries = options["countries"]
+        ts_cumulative = np.reshape(
+            [data_dict[country] for country in countries],
+            (len(countries), len(data_dict["dates"])),
+        )
+        return get_weighted_series, (
+            ts_cumulative,
+            results[("weights",) + key[1:]],
+            options["fwd_weights"],
+        )
+    if stage == "r_eff":
+        reported, activity, load = results[("convolution",) + key[1:3]]
+        tau, mode = key[3:]
+        return _fit_r_eff, (load, activity, tau, mode, options["params"]["backend"])
+    if stage == "pvals":
+        country = key[-1]
+        k = options["index"][country]
+        data_dict = results[("ingest",)]
+        reported, activity, load = results[("convolution",) + key[1:3]]
+        r_eff_case, r_eff_fits = results[("r_eff",) + key[1:5]]
+        combination = {
+            "mode": key[4],
+            "tau": list(key[3]),
+            "distribution": key[5],
+        }
+        results_dir = "{}/{}/{}".format(
+            options["output"],
+            get_sweep_name(dict(combination, gamma_mean=key[1], gamma_std=key[2])),
+            os.path.basename(get_results_dir(country, combination["mode"])),
+        )
+        return _compute_sweep_country, (
+            data_dict[country],
+            data_dict["dates"],
+            (reported[k], activity[k], load[k]),
+            (r_eff_case[k], r_eff_fits[k]),
+            options["seeds"][k],
+            dict(options["params"], **combination),
+            results_dir,
+            options["format"],
+        )
+    raise ValueError("unknown stage of the sweep")
+
+
+def _get_inv_weights(gamma_mean, gamma_std):
+    return get_weights("inv", "gamma", mean=gamma_mean, std=gamma_std)
+
+
+def _fit_r_eff(load, activity, tau, mode, backend):
+    return get_r_eff_case_batch(
+        load, activity, tau[0], tau[1], mode=mode, backend=backend
+    )
+
+
+def _compute_sweep_country(
+    ts_cumulative, dates, weighted, r_eff, seed, params, results_dir, format
+):
+    # the weights are only needed without weighted
+    results = compute_country(
+        ts_cumulative,
+        None,
+        None,
+        rng=np.random.default_rng(seed),
+        weighted=weighted,
+        r_eff=r_eff,
+        **params
+    )
+    save_dict = {"pvals": results.pop("pvals"), "dates": dates}
+    save_dict.update(results)
+    save_data(results_dir, save_dict, format=format)
+    return results_dir
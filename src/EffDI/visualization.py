@@ -8,6 +8,8 @@ import pandas as pd
 
 import matplotlib.colors as mcolors
 
+from EffDI.computation import load_data
+
 cmap = mcolors.LinearSegmentedColormap.from_list(
     "map", ["white", "#14f000", "#14f000", "#0d9900"]
 )
@@ -76,8 +78,9 @@ def smooth(x, window_len=15, window="hanning"):
     return y[offset:-offset]
 
 
-def load_data(dir):
-    return dict(np.load(dir + "/pvals.npz"))
+def get_level_set_index(p0s, p0=0.9):
+    """index of the level set line closest to the level p0"""
+    return int(np.argmin(np.abs(np.asarray(p0s) - p0)))
 
 
 def compute_average_range(ts_data, ts_dates, date_interval):
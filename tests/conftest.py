@@ -0,0 +1,31 @@
+import numpy as np
+import pytest
+
+from EffDI.benchmark import generate_series
+from EffDI.computation import get_weighted_series
+from EffDI.pre_compute_weights import get_weights
+
+
+@pytest.fixture(scope="session")
+def weights():
+    return get_weights("inv", "gamma"), get_weights("fwd", "delta")
+
+
+@pytest.fixture(scope="session")
+def cumulative():
+    """a synthetic cumulative series of 120 days"""
+
+    return generate_series(n_days=120, level=200, rng=0)
+
+
+@pytest.fixture(scope="session")
+def weighted(cumulative, weights):
+    """reported cases, activity and load of cumulative; the load has days
+    without infections, so that the fits mask some days"""
+
+    reported, activity, load = (
+        series[0] for series in get_weighted_series(cumulative[np.newaxis], *weights)
+    )
+    load = load.copy()
+    load[[30, 31, 45, 52, 59, 66]] = 0
+    return reported, activity, load
@@ -0,0 +1,98 @@
+import os
+import shutil
+
+import numpy as np
+
+from EffDI.benchmark import generate_series
+from EffDI.cache import (
+    get_cache_entry,
+    get_cache_key,
+    restore_from_cache,
+    store_in_cache,
+)
+from EffDI.computation import load_data
+from EffDI.compute import compute
+
+
+def _write_results(results_dir, size):
+    os.makedirs(results_dir, exist_ok=True)
+    with open(os.path.join(results_dir, "pvals.npz"), "wb") as f:
+        f.write(os.urandom(size))
+
+
+def test_cache_key_depends_on_arrays_and_params():
+    a = np.arange(10, dtype=np.float32)
+    key = get_cache_key([a], {"n": 500})
+
+    assert get_cache_key([a.copy()], {"n": 500}) == key
+    assert get_cache_key([a], {"n": 501}) != key
+    assert get_cache_key([a.astype(np.float64)], {"n": 500}) != key
+
+
+def test_cache_hit(tmp_path):
+    cache_dir = str(tmp_path / "cache")
+    results_dir = str(tmp_path / "results")
+    _write_results(results_dir, 100)
+    with open(os.path.join(results_dir, "pvals.npz"), "rb") as f:
+        content = f.read()
+    store_in_cache(cache_dir, "a", results_dir, max_size=2**20)
+
+    assert get_cache_entry(cache_dir, "b") is None
+    assert not restore_from_cache(cache_dir, "b", results_dir)
+
+    restored_dir = str(tmp_path / "restored")
+    assert restore_from_cache(cache_dir, "a", restored_dir)
+    with open(os.path.join(restored_dir, "pvals.npz"), "rb") as f:
+        assert f.read() == content
+
+
+def test_cache_evicts_least_recently_used(tmp_path):
+    cache_dir = str(tmp_path / "cache")
+    for key in ["a", "b"]:
+        _write_results(str(tmp_path / key), 100)
+        store_in_cache(cache_dir, key, str(tmp_path / key), max_size=250)
+    # a is used after b, so b is evicted first
+    os.utime(os.path.join(cache_dir, "b"), (0, 0))
+    os.utime(os.path.join(cache_dir, "a"), (1, 1))
+
+    _write_results(str(tmp_path / "c"), 100)
+    store_in_cache(cache_dir, "c", str(tmp_path / "c"), max_size=250)
+
+    assert get_cache_entry(cache_dir, "a") is not None
+    assert get_cache_entry(cache_dir, "b") is None
+    assert get_cache_entry(cache_dir, "c") is not None
+
+
+def _write_data(filename, series):
+    dates = np.datetime64("2020-01-22") + np.arange(len(series))
+    header = ["Province/State", "Country/Region", "Lat", "Long"] + [
+        "{}/{}/{}".format(d.month, d.day, d.year % 100) for d in dates.tolist()
+    ]
+    with open(filename, "w") as f:
+        f.write(",".join(header) + "\n")
+        f.write(",".join(["", "Austria", "0", "0"] + ["%d" % v for v in series]))
+        f.write("\n")
+
+
+def test_incremental_results_are_not_cached(tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    series = generate_series(n_days=120, level=200, rng=1)
+    _write_data("short.csv", series[:100])
+    _write_data("full.csv", series)
+    params = {
+        "inv_weights": "gamma",
+        "fwd_weights": "delta",
+        "k_samp": 10,
+        "n": 50,
+        "seed": 5,
+    }
+
+    compute(data_file="short.csv", **params)
+    compute(data_file="full.csv", incremental=True, cache_dir="cache", **params)
+    compute(data_file="full.csv", cache_dir="cache", **params)
+    cached = load_data("results/austria_st")
+    shutil.rmtree("results")
+    compute(data_file="full.csv", **params)
+    fresh = load_data("results/austria_st")
+
+    np.testing.assert_array_equal(cached["pvals"], fresh["pvals"])
@@ -0,0 +1,307 @@
+import numpy as np
+import pytest
+
+import EffDI.computation
+from EffDI.computation import (
+    apply_weights_batch,
+    compute_level_set_lines,
+    get_level_set_lines_adaptive,
+    get_linear_system,
+    get_pvals,
+    get_r_eff_case,
+    get_sample_windows,
+    get_shared_window_pvals,
+    get_window_pvals,
+    get_window_pvals_analytic,
+)
+
+
+def _get_r_eff_case_loop(incid_daily, secondary_infections, tau1, tau2, mode):
+    """get_r_eff_case of the first version, one pseudo inverse per day"""
+
+    ts_r_eff = np.zeros_like(incid_daily, dtype=np.float64)
+    ts_r_eff[0:tau1] = np.nan
+    if tau2 != 0:
+        ts_r_eff[-tau2:] = np.nan
+    r_eff_fits = np.full([len(incid_daily), tau1 + tau2 + 1], np.nan)
+
+    for k in range(tau1, len(ts_r_eff) - tau2):
+        window = slice(k - tau1, k + tau2 + 1)
+        A, b = get_linear_system(
+            incid_daily[window].astype(np.float64),
+            secondary_infections[window],
+            mode,
+        )
+        incid_gt_zero = incid_daily[window] > 0
+        weekday_gt_zero = [np.sum(incid_gt_zero[j::7]) for j in range(7)]
+        A2 = A[incid_gt_zero, :]
+        coeffs = np.matmul(np.linalg.pinv(A2), b[incid_gt_zero])
+
+        r_eff_fits[k, incid_gt_zero] = np.divide(
+            np.squeeze(np.matmul(A2, coeffs)), incid_daily[window][incid_gt_zero]
+        )
+        if mode == "c":
+            ts_r_eff[k] = coeffs[0, 0]
+        if mode == "t":
+            ts_r_eff[k] = coeffs[0, 0] * tau1 + coeffs[1, 0]
+        if mode == "st":
+            if np.sum(incid_gt_zero) > 0:
+                ts_r_eff[k] = coeffs[0, 0] * tau1 + np.sum(
+                    np.reshape(weekday_gt_zero, [7, 1]) * coeffs[1:]
+                ) / np.sum(incid_gt_zero)
+            else:
+                ts_r_eff[k] = np.nan
+    return ts_r_eff, r_eff_fits
+
+
+def _get_pvals_loop(incid_daily, secondary_infections, kappas, tau1, tau2, n, rng):
+    """get_pvals of the first version with gamma samples, one day at a time"""
+
+    r_eff_case, r_eff_fits = _get_r_eff_case_loop(
+        incid_daily, secondary_infections, tau1, tau2, "t"
+    )
+    p_vals_full = np.full([len(kappas), len(incid_daily)], np.nan)
+    for k, kappa in enumerate(kappas):
+        for idx in range(tau1, len(incid_daily) - tau2):
+            idxs_nan = np.isnan(r_eff_fits[idx])
+            if np.sum(idxs_nan) > len(idxs_nan) // 2:
+                continue
+            window = slice(idx - tau1, idx + tau2 + 1)
+            r_eff_fit = r_eff_fits[idx][~idxs_nan]
+            incid = incid_daily[window][~idxs_nan]
+            scale = np.clip(np.clip(r_eff_fit, None, 100) * incid / kappa, 0, None)
+            samples = rng.gamma(kappa, scale=scale, size=[n, len(scale)])
+            means = r_eff_fit * incid
+            sec_inf = secondary_infections[window][~idxs_nan]
+            test_statistic = np.sum(np.square(means - sec_inf))
+            test_statistic_samples = np.sum(np.square(means - samples), axis=1)
+            p_vals_full[k, idx] = np.mean(test_statistic_samples >= test_statistic)
+    return p_vals_full
+
+
+@pytest.mark.parametrize("mode", ["c", "t", "st"])
+def test_r_eff_case_matches_loop(weighted, mode):
+    _, activity, load = weighted
+    r_eff_case, r_eff_fits = get_r_eff_case(load, activity, 6, 7, mode=mode)
+    expected_case, expected_fits = _get_r_eff_case_loop(load, activity, 6, 7, mode)
+
+    np.testing.assert_allclose(r_eff_fits, expected_fits, rtol=1e-6, atol=1e-9)
+    np.testing.assert_allclose(r_eff_case, expected_case, rtol=1e-6, atol=1e-9)
+
+
+def test_level_set_lines_match_loop():
+    rng = np.random.default_rng(0)
+    kappas = np.flip(np.logspace(-1, 4, 50))
+    p0s = [0.8, 0.9]
+    # p-values that increase with kappa up to noise, with nan days and days
+    # where no kappa reaches a level
+    pvals = np.sort(rng.random([50, 40]), axis=0) + rng.normal(0, 0.05, [50, 40])
+    pvals[:, :3] = np.nan
+    pvals[:, 10] = 0.1
+
+    expected = np.zeros((len(p0s), pvals.shape[1]))
+    for k in range(len(p0s)):
+        for j in range(pvals.shape[1]):
+            for i in range(pvals.shape[0]):
+                if pvals[i, j] > p0s[k]:
+                    expected[k, j] = kappas[i]
+                    break
+
+    np.testing.assert_array_equal(compute_level_set_lines(pvals, kappas, p0s), expected)
+
+
+def test_pvals_match_loop_within_monte_carlo_noise(weighted):
+    _, activity, load = weighted
+    kappas = np.array([100.0, 10.0, 1.0])
+    n = 4000
+    pvals, _, _ = get_pvals(load, activity, kappas, 6, 7, n, mode="t", rng=1)
+    expected = _get_pvals_loop(
+        load, activity, kappas, 6, 7, n, np.random.default_rng(2)
+    )
+
+    np.testing.assert_array_equal(np.isnan(pvals), np.isnan(expected))
+    # two independent estimates of the same probability, five standard
+    # errors of their difference
+    days = ~np.isnan(expected)
+    p = (pvals[days] + expected[days]) / 2
+    tolerance = 5 * np.sqrt(2 * p * (1 - p) / n) + 1 / n
+    assert np.all(np.abs(pvals[days] - expected[days]) <= tolerance)
+
+
+@pytest.mark.parametrize("dtype", [np.float64, np.float32])
+def test_shared_samples_cumulative_sums_match_windows(weighted, dtype):
+    _, activity, load = weighted
+    r_eff_case, r_eff_fits = get_r_eff_case(load, activity, 6, 7, mode="c")
+    windows = get_sample_windows(load, activity, r_eff_fits, 6, 7, dtype=dtype)
+    assert np.any(windows["incid"] == 0)
+
+    for kappa in [0.3, 3, 30, 3000]:
+        # both draw the same variates, so only the rounding differs
+        cumulative = get_shared_window_pvals(
+            windows,
+            load,
+            6,
+            kappa,
+            500,
+            "gamma",
+            np.random.default_rng(0),
+            r_eff_constant=r_eff_case[windows["days"]],
+        )
+        strided = get_shared_window_pvals(
+            windows, load, 6, kappa, 500, "gamma", np.random.default_rng(0)
+        )
+        np.testing.assert_allclose(cumulative, strided, atol=1 / 500)
+
+
+def test_shared_samples_of_mode_c_use_cumulative_sums(weighted, monkeypatch):
+    _, activity, load = weighted
+    calls = []
+    window_sums = EffDI.computation._window_sums
+
+    def count_window_sums(*args):
+        calls.append(1)
+        return window_sums(*args)
+
+    monkeypatch.setattr(EffDI.computation, "_window_sums", count_window_sums)
+    get_pvals(load, activity, [10.0], 6, 7, 100, mode="t", shared_samples=True)
+    assert not calls
+    get_pvals(load, activity, [10.0], 6, 7, 100, mode="c", shared_samples=True)
+    assert calls
+
+
+@pytest.mark.parametrize("crn", [False, True])
+def test_adaptive_search_close_to_dense_search(weighted, crn):
+    _, activity, load = weighted
+    kappas = np.flip(np.logspace(-1, 4, 60))
+    p0s = [0.8, 0.85, 0.9, 0.95]
+    pvals, _, _ = get_pvals(load, activity, kappas, 6, 7, 500, rng=0, crn=crn)
+    dense = compute_level_set_lines(pvals, kappas, p0s)
+    adaptive, _, _ = get_level_set_lines_adaptive(
+        load, activity, kappas, p0s, 6, 7, 500, rng=0, crn=crn
+    )
+
+    # days without a level agree, the others differ by at most two grid
+    # points where the p-values hover around p0
+    np.testing.assert_array_equal(adaptive == 0, dense == 0)
+    found = dense > 0
+    grid = {kappa: k for k, kappa in enumerate(kappas)}
+    steps = [abs(grid[a] - grid[d]) for a, d in zip(adaptive[found], dense[found])]
+    assert max(steps) <= 2
+
+
+def _sample_model(windows, kappa, distribution, n_samples, rng):
+    scale = np.clip(
+        np.clip(windows["r_eff"], None, 100) * windows["incid"] / kappa, 0, None
+    )
+    return EffDI.computation._draw_samples(
+        scale[:, np.newaxis, :],
+        kappa,
+        distribution,
+        (len(scale), n_samples, scale.shape[1]),
+        rng,
+    )
+
+
+@pytest.mark.parametrize("distribution", ["gamma", "NB"])
+def test_model_cumulants_match_exact_moments(distribution):
+    from scipy import stats
+    from scipy.special import comb
+
+    for k, scale in [(0.5, 4.0), (5.0, 2.0), (50.0, 0.3)]:
+        if distribution == "gamma":
+            model = stats.gamma(k, scale=scale)
+        else:
+            model = stats.nbinom(k, 1 / (1 + scale))
+        # cumulants from the raw moments
+        moments = [1.0] + [model.moment(j) for j in range(1, 7)]
+        expected = []
+        for n in range(1, 7):
+            expected.append(
+                moments[n]
+                - sum(
+                    comb(n - 1, m - 1) * expected[m - 1] * moments[n - m]
+                    for m in range(1, n)
+                )
+            )
+        cumulants = EffDI.computation._model_cumulants(
+            np.array(scale), np.array(k), distribution
+        )
+        np.testing.assert_allclose(cumulants, expected, rtol=1e-6)
+
+
+@pytest.mark.parametrize("distribution", ["gamma", "NB"])
+def test_statistic_cumulants_match_sampling(weighted, distribution):
+    from scipy import stats
+
+    _, activity, load = weighted
+    _, r_eff_fits = get_r_eff_case(load, activity, 6, 7, mode="t")
+    windows = get_sample_windows(load, activity, r_eff_fits, 6, 7)
+    kappa = 50.0
+    mean, var, k3, reliable = EffDI.computation._get_statistic_cumulants(
+        windows, kappa, distribution, EffDI.computation.ANALYTIC_MAX_SKEWNESS
+    )
+    some = np.nonzero(reliable)[0][::20]
+    windows = EffDI.computation.select_windows(windows, some)
+    samples = _sample_model(
+        windows, kappa, distribution, 200000, np.random.default_rng(0)
+    )
+    statistic = np.sum((samples - windows["means"][:, np.newaxis]) ** 2, axis=-1)
+
+    np.testing.assert_allclose(np.mean(statistic, axis=1), mean[some], rtol=0.005)
+    np.testing.assert_allclose(np.var(statistic, axis=1), var[some], rtol=0.02)
+    np.testing.assert_allclose(
+        [stats.kstat(t, 3) for t in statistic], k3[some], rtol=0.1
+    )
+
+
+@pytest.mark.parametrize("distribution", ["gamma", "NB"])
+@pytest.mark.parametrize("kappa", [50.0, 500.0])
+def test_analytic_pvals_match_sampling(weighted, distribution, kappa):
+    _, activity, load = weighted
+    _, r_eff_fits = get_r_eff_case(load, activity, 6, 7, mode="t")
+    windows = get_sample_windows(load, activity, r_eff_fits, 6, 7)
+    # test statistics drawn from the model, so that the p-values spread
+    # over (0, 1) instead of vanishing
+    sample = _sample_model(windows, kappa, distribution, 1, np.random.default_rng(0))
+    windows["test_statistic"] = np.sum((sample[:, 0] - windows["means"]) ** 2, axis=1)
+
+    analytic = get_window_pvals_analytic(windows, kappa, distribution)
+    n = 20000
+    sampled = get_window_pvals(
+        windows, kappa, n, distribution, np.random.default_rng(1)
+    )
+
+    reliable = ~np.isnan(analytic)
+    assert np.mean(reliable) > 0.9
+    # the approximation error of a few hundredths where a few days dominate a
+    # window plus the monte carlo error
+    error = np.abs(analytic - sampled)[reliable]
+    assert np.mean(error) < 0.01
+    assert np.max(error) < 0.05
+
+
+def test_fft_convolution_matches_direct(weights):
+    rng = np.random.default_rng(0)
+    data = rng.gamma(0.5, 100, size=(20, 300))
+    # runs of days without cases, at the start, inside and at the end
+    data[:, :15] = 0
+    data[:, 100:190] = 0
+    data[:5, 250:] = 0
+    for w in weights:
+        direct = apply_weights_batch(data, *w, method="direct")
+        fft = apply_weights_batch(data, *w, method="fft")
+        np.testing.assert_array_equal(fft == 0, direct == 0)
+        np.testing.assert_allclose(fft, direct, rtol=1e-9, atol=1e-9)
+
+
+def test_fft_convolution_keeps_tiny_loads(weights):
+    # the tail of a single case next to a large series is far below the
+    # round-off of the large series, but not zero
+    data = np.zeros((1, 400))
+    data[0, 10] = 1
+    data[0, 200:] = 1e5
+    direct = apply_weights_batch(data, *weights[0], method="direct")
+    fft = apply_weights_batch(data, *weights[0], method="fft")
+    assert 0 < direct[0, 80] < 1e-8
+    np.testing.assert_array_equal(fft == 0, direct == 0)
+    np.testing.assert_allclose(fft, direct, rtol=0.05, atol=1e-10)
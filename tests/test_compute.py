@@ -0,0 +1,122 @@
+import numpy as np
+import pytest
+
+from EffDI.benchmark import generate_series
+from EffDI.computation import get_accuracy_report
+from EffDI.compute import compute_batch, compute_country, get_first_changed_day
+
+PARAMS = {"k_samp": 20, "n": 100, "tau": [6, 7], "mode": "st"}
+
+
+@pytest.fixture(scope="module")
+def updated(weights):
+    """results of 100 days, and the results with 20 more days computed from
+    them"""
+
+    series = generate_series(n_days=120, level=200, rng=1)
+    previous = compute_country(series[:100], *weights, rng=0, **PARAMS)
+    results = compute_country(series, *weights, rng=0, previous=previous, **PARAMS)
+    return previous, results
+
+
+def test_incremental_reuses_unchanged_days(updated):
+    previous, results = updated
+    # the fits of the days up to 100 - tau2 do not see the new days
+    first_day = 100 - PARAMS["tau"][1]
+    for key in ["pvals", "r_eff_case", "kappa_level_set_lines"]:
+        np.testing.assert_array_equal(
+            results[key][..., :first_day], previous[key][..., :first_day]
+        )
+    assert not np.array_equal(
+        results["pvals"][:, first_day:100], previous["pvals"][:, first_day:]
+    )
+
+
+def test_incremental_matches_full_fits(updated, weights):
+    _, results = updated
+    series = generate_series(n_days=120, level=200, rng=1)
+    full = compute_country(series, *weights, rng=0, **PARAMS)
+
+    np.testing.assert_allclose(results["r_eff_case"], full["r_eff_case"])
+    assert np.isnan(results["pvals"]).sum() == np.isnan(full["pvals"]).sum()
+
+
+@pytest.mark.parametrize(
+    "changed",
+    [
+        {"tau": [5, 8]},
+        {"distribution": "NB"},
+        {"n": 200},
+        {"crn": True},
+        {"dtype": "float32"},
+        {"pvalue_method": "analytic"},
+    ],
+)
+def test_incremental_recomputes_after_parameter_change(updated, weights, changed):
+    previous, _ = updated
+    series = generate_series(n_days=120, level=200, rng=1)
+    params = dict(PARAMS, **changed)
+    results = compute_country(series, *weights, rng=0, previous=previous, **params)
+    full = compute_country(series, *weights, rng=0, **params)
+
+    for key in ["pvals", "r_eff_case", "kappa_level_set_lines"]:
+        np.testing.assert_array_equal(results[key], full[key])
+
+
+def test_first_changed_day_without_run_parameters(updated):
+    previous, results = updated
+    previous = {k: v for k, v in previous.items() if k != "run_parameters"}
+    first_day = get_first_changed_day(
+        previous,
+        results["infectious_load"],
+        results["infectious_activity"],
+        results["kappas"],
+        results["p0s"],
+        PARAMS["tau"],
+        True,
+        results["run_parameters"],
+    )
+    assert first_day == 0
+
+
+@pytest.mark.parametrize("crn", [False, True])
+def test_accuracy_report_measures_rounding(weights, crn):
+    series = generate_series(n_days=120, level=200, rng=1)
+    params = dict(PARAMS, crn=crn)
+    results = compute_country(
+        series, *weights, rng=0, dtype="float32", variates_dtype="float64", **params
+    )
+    reference = compute_country(series, *weights, rng=0, **params)
+    report = get_accuracy_report(results, reference, PARAMS["n"])
+
+    # the same random numbers, so the p-values differ only by rounding
+    assert report["pvals_nan_mismatch"] == 0
+    assert report["pvals_max_abs_diff"] < 1e-6
+    assert report["kappa_level_zero_mismatch"] == 0
+
+
+@pytest.mark.parametrize("crn", [False, True])
+def test_batch_matches_compute_country(weights, crn):
+    series = np.array([generate_series(n_days=80, level=200, rng=k) for k in range(3)])
+    params = dict(PARAMS, crn=crn)
+
+    # a batch of one series draws the random numbers of compute_country
+    single = compute_batch(series[:1], *weights, rng=0, **params)
+    expected = compute_country(series[0], *weights, rng=0, **params)
+    for key in ["pvals", "r_eff_case", "r_eff_fits", "kappa_level_set_lines"]:
+        np.testing.assert_array_equal(single[key][0], expected[key])
+
+    # in larger batches the series share the random numbers, only the
+    # weighted series and the fits agree bit for bit
+    batch = compute_batch(series, *weights, rng=0, **params)
+    n = PARAMS["n"]
+    for k in range(len(series)):
+        expected = compute_country(series[k], *weights, rng=0, **params)
+        for key in ["infectious_load", "infectious_activity", "r_eff_fits"]:
+            np.testing.assert_array_equal(batch[key][k], expected[key])
+        pvals = batch["pvals"][k]
+        np.testing.assert_array_equal(np.isnan(pvals), np.isnan(expected["pvals"]))
+        days = ~np.isnan(pvals)
+        p = (pvals[days] + expected["pvals"][days]) / 2
+        tolerance = 5 * np.sqrt(2 * p * (1 - p) / n) + 1 / n
+        assert np.all(np.abs(pvals[days] - expected["pvals"][days]) <= tolerance)
@@ -0,0 +1,157 @@
+import os
+
+import numpy as np
+import pandas as pd
+import pytest
+
+from EffDI.computation import get_data_dict
+from EffDI.ingestion import (
+    aggregate_groups,
+    iter_groups,
+    iter_series,
+    load_data_matrix,
+    load_grouping,
+)
+
+ROWS = [
+    ("", "Austria"),
+    ("Ontario", "Canada"),
+    ("Quebec", "Canada"),
+    ("", "Korea, South"),
+    ("Hubei", "China"),
+    ("Beijing", "China"),
+    ("", "China"),
+]
+
+
+@pytest.fixture
+def data_file(tmp_path):
+    """a wide time series file with provinces and a quoted country name"""
+
+    rng = np.random.default_rng(0)
+    dates = pd.date_range("2020-01-22", periods=50)
+    values = np.cumsum(rng.integers(0, 10**6, size=(len(ROWS), len(dates))), axis=1)
+    data = pd.DataFrame(values, columns=[d.strftime("%-m/%-d/%y") for d in dates])
+    data.insert(0, "Province/State", [province or None for province, _ in ROWS])
+    data.insert(1, "Country/Region", [country for _, country in ROWS])
+    data.insert(2, "Lat", 0.0)
+    data.insert(3, "Long", 0.0)
+    filename = str(tmp_path / "data.csv")
+    data.to_csv(filename, index=False)
+    return filename
+
+
+def _get_data_dict_pandas(filename):
+    """get_data_dict of the first version, a groupby of the countries"""
+
+    data = (
+        pd.read_csv(filename)
+        .drop(["Province/State", "Lat", "Long"], axis=1)
+        .groupby("Country/Region")
+        .sum()
+    )
+    ts_dict = {"dates": pd.to_datetime(data.columns).to_numpy("datetime64[D]")}
+    for index in data.index:
+        ts_dict[index] = data.loc[index].values.astype(np.float32)
+    return ts_dict
+
+
+def _aggregate_groups_pandas(filename, grouping):
+    """aggregate_groups as a groupby of the row names"""
+
+    data = pd.read_csv(filename)
+    province = data.pop("Province/State")
+    country = data.pop("Country/Region")
+    data = data.drop(["Lat", "Long"], axis=1)
+    row_names = (province + ", " + country).fillna(country)
+    if grouping == "province":
+        return dict(zip(row_names, data.to_numpy(np.float32)))
+    return {
+        name: data[country.isin(members) | row_names.isin(members)]
+        .sum()
+        .to_numpy(np.float32)
+        for name, members in grouping.items()
+    }
+
+
+GROUPINGS = {
+    "Americas": ["Canada"],
+    "Asia": ["Korea, South", "Hubei, China"],
+    # China contains Hubei, which is counted once
+    "Rest": ["Austria", "China", "Hubei, China"],
+}
+
+
+def _assert_dicts_equal(ts_dict, expected):
+    assert list(ts_dict) == list(expected)
+    for key in expected:
+        assert ts_dict[key].dtype == expected[key].dtype
+        np.testing.assert_array_equal(ts_dict[key], expected[key])
+
+
+@pytest.mark.parametrize("cache", [False, True])
+def test_data_dict_matches_groupby(data_file, cache):
+    expected = _get_data_dict_pandas(data_file)
+    _assert_dicts_equal(get_data_dict(data_file, cache=cache), expected)
+    # the second call reads the cache
+    _assert_dicts_equal(get_data_dict(data_file, cache=cache), expected)
+
+
+def test_cache_follows_the_file(data_file):
+    assert not isinstance(load_data_matrix(data_file)["values"], np.memmap)
+    matrix = load_data_matrix(data_file)
+    assert isinstance(matrix["values"], np.memmap)
+
+    # touching the file keeps the cache
+    os.utime(data_file, (0, 0))
+    np.testing.assert_array_equal(
+        load_data_matrix(data_file)["values"], matrix["values"]
+    )
+
+    # a changed file is parsed again
+    data = pd.read_csv(data_file)
+    data.iloc[0, -1] += 1
+    data.to_csv(data_file, index=False)
+    values = load_data_matrix(data_file)["values"]
+    assert values[0, -1] == matrix["values"][0, -1] + 1
+
+
+@pytest.mark.parametrize("grouping", ["province", GROUPINGS])
+def test_groups_match_groupby(data_file, grouping):
+    expected = _aggregate_groups_pandas(data_file, grouping)
+    names, values = aggregate_groups(load_data_matrix(data_file), grouping)
+    assert names == list(expected)
+    np.testing.assert_array_equal(values, np.array(list(expected.values())))
+
+
+@pytest.mark.parametrize("grouping", ["country", "province", GROUPINGS])
+def test_iter_groups_match_aggregate_groups(data_file, grouping):
+    matrix = load_data_matrix(data_file)
+    names, values = aggregate_groups(matrix, grouping)
+    for (name, series), expected_name, expected in zip(
+        iter_groups(matrix, grouping=grouping), names, values
+    ):
+        assert name == expected_name
+        assert series.dtype == expected.dtype
+        np.testing.assert_array_equal(series, expected)
+
+    # a selection of groups in its own order
+    selection = names[::-2]
+    series = dict(iter_series(data_file, selection, grouping=grouping))
+    assert list(series) == selection
+    for name in selection:
+        np.testing.assert_array_equal(series[name], values[names.index(name)])
+
+
+def test_unknown_members_and_groupings(data_file, tmp_path):
+    matrix = load_data_matrix(data_file)
+    with pytest.raises(KeyError):
+        aggregate_groups(matrix, {"Europe": ["Austria", "Ontario"]})
+    with pytest.raises(ValueError):
+        aggregate_groups(matrix, "continent")
+
+    filename = str(tmp_path / "grouping.json")
+    with open(filename, "w") as f:
+        f.write('{"Europe": "Austria"}')
+    with pytest.raises(ValueError):
+        load_grouping(filename)
@@ -0,0 +1,77 @@
+import numpy as np
+import pytest
+
+from EffDI.backends import NUMPY_KERNELS, get_backend
+from EffDI.computation import get_design_pattern
+
+pytest.importorskip("numba")
+
+DTYPES = [np.float64, np.float32]
+
+
+@pytest.fixture(scope="module")
+def numba_kernels():
+    return get_backend("numba")
+
+
+@pytest.mark.parametrize("dtype", DTYPES)
+def test_window_exceedances(numba_kernels, dtype):
+    rng = np.random.default_rng(0)
+    samples = rng.gamma(2.0, 10.0, size=(50, 200, 14)).astype(dtype)
+    means = rng.uniform(10, 30, size=(50, 14)).astype(dtype)
+    test_statistic = rng.uniform(1000, 6000, size=50).astype(dtype)
+
+    # the numpy kernel overwrites the samples
+    expected = NUMPY_KERNELS["window_exceedances"](
+        samples.copy(), means, test_statistic
+    )
+    counts = numba_kernels["window_exceedances"](samples, means, test_statistic)
+
+    assert 0 < np.sum(expected) < samples.shape[0] * samples.shape[1]
+    np.testing.assert_array_equal(counts, expected)
+
+
+@pytest.mark.parametrize("mode", ["c", "t", "st"])
+@pytest.mark.parametrize("dtype", DTYPES)
+def test_solve_windows(numba_kernels, mode, dtype):
+    rng = np.random.default_rng(1)
+    x = rng.uniform(10, 100, size=(40, 14))
+    y = 1.2 * x + rng.normal(0, 5, size=x.shape)
+    # days without infections are zeroed as in get_r_eff_case_batch; with
+    # mode st the windows where a weekday is missing are rank deficient
+    x[::2, [0, 7]] = 0
+    x[1::4, 3:9] = 0
+    incid_gt_zero = x > 0
+    A = (x[:, :, np.newaxis] * get_design_pattern(14, mode)).astype(dtype)
+    b = np.where(incid_gt_zero, y, 0).astype(dtype)
+    if mode == "st":
+        assert np.any(np.linalg.matrix_rank(A.astype(np.float64)) < A.shape[2])
+
+    expected = NUMPY_KERNELS["solve_windows"](A, b)
+    coeffs = numba_kernels["solve_windows"](A, b)
+
+    rtol = 1e-9 if dtype == np.float64 else 1e-3
+    np.testing.assert_allclose(coeffs, expected, rtol=rtol, atol=rtol)
+    np.testing.assert_allclose(
+        np.matmul(A, coeffs[:, :, np.newaxis]),
+        np.matmul(A, expected[:, :, np.newaxis]),
+        rtol=rtol,
+        atol=rtol,
+    )
+
+
+@pytest.mark.parametrize("dtype", DTYPES)
+def test_level_set_lines(numba_kernels, dtype):
+    rng = np.random.default_rng(2)
+    kappas = np.flip(np.logspace(-1, 4, 60))
+    p0s = [0.8, 0.85, 0.9, 0.95]
+    pvals = np.sort(rng.random([60, 80]), axis=0) + rng.normal(0, 0.05, [60, 80])
+    pvals[:, :5] = np.nan
+    pvals[::7, 20:30] = np.nan
+    pvals[:, 40] = 0.5
+    pvals = pvals.astype(dtype)
+
+    np.testing.assert_array_equal(
+        numba_kernels["level_set_lines"](pvals, kappas, p0s),
+        NUMPY_KERNELS["level_set_lines"](pvals, kappas, p0s),
+    )
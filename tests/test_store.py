@@ -0,0 +1,114 @@
+import os
+
+import numpy as np
+
+from EffDI.store import append_to_store, compact_store, read_store, stack_store
+
+
+def _results(n_days, start, value):
+    return {
+        "dates": np.datetime64(start) + np.arange(n_days),
+        "r_eff_case": np.full(n_days, value),
+        "pvals": np.full([3, n_days], value, dtype=np.float32),
+        "kappas": np.array([100.0, 10.0, 1.0]),
+    }
+
+
+def _assert_equal(stored, results):
+    assert stored.keys() == results.keys()
+    for key in results:
+        assert stored[key].dtype == results[key].dtype
+        np.testing.assert_array_equal(stored[key], results[key])
+
+
+def test_store_round_trip(tmp_path):
+    store_dir = str(tmp_path / "store")
+    austria = _results(10, "2020-01-22", 1.0)
+    italy = _results(12, "2020-01-20", 2.0)
+    append_to_store(store_dir, "Austria", "st", austria)
+    append_to_store(store_dir, "Italy", "st", italy)
+    append_to_store(store_dir, "Italy", "c", italy)
+
+    data = read_store(store_dir)
+    assert set(data) == {("Austria", "st"), ("Italy", "st"), ("Italy", "c")}
+    _assert_equal(data[("Austria", "st")], austria)
+    _assert_equal(data[("Italy", "st")], italy)
+
+    selected = read_store(store_dir, ["Italy"], ["st"], ["pvals"])
+    assert list(selected) == [("Italy", "st")]
+    assert list(selected[("Italy", "st")]) == ["pvals"]
+
+
+def test_store_replaces_entries(tmp_path):
+    store_dir = str(tmp_path / "store")
+    append_to_store(store_dir, "Austria", "st", _results(10, "2020-01-22", 1.0))
+    updated = _results(11, "2020-01-22", 3.0)
+    append_to_store(store_dir, "Austria", "st", updated)
+
+    data = read_store(store_dir)
+    assert list(data) == [("Austria", "st")]
+    _assert_equal(data[("Austria", "st")], updated)
+
+
+def test_stack_store_aligns_dates(tmp_path):
+    store_dir = str(tmp_path / "store")
+    append_to_store(store_dir, "Austria", "st", _results(10, "2020-01-22", 1.0))
+    append_to_store(store_dir, "Italy", "st", _results(12, "2020-01-20", 2.0))
+
+    dates, countries, stacked = stack_store(store_dir, "r_eff_case")
+    assert countries == ["Austria", "Italy"]
+    np.testing.assert_array_equal(dates, np.datetime64("2020-01-20") + np.arange(12))
+    assert np.all(np.isnan(stacked[0, :2]))
+    np.testing.assert_array_equal(stacked[0, 2:], 1.0)
+    np.testing.assert_array_equal(stacked[1], 2.0)
+
+    _, _, pvals = stack_store(store_dir, "pvals")
+    assert pvals.shape == (2, 3, 12)
+
+
+def _store_size(store_dir):
+    return sum(
+        os.path.getsize(os.path.join(store_dir, file))
+        for file in os.listdir(store_dir)
+        if file.endswith(".bin")
+    )
+
+
+def test_store_reclaims_replaced_entries(tmp_path):
+    store_dir = str(tmp_path / "store")
+    italy = _results(12, "2020-01-20", 2.0)
+    append_to_store(store_dir, "Italy", "st", italy)
+    for value in range(10):
+        append_to_store(
+            store_dir, "Austria", "st", _results(10, "2020-01-22", float(value))
+        )
+
+    # the replaced arrays take at most as much space as the entries
+    live_size = sum(
+        value.nbytes
+        for entry in read_store(store_dir).values()
+        for value in entry.values()
+    )
+    assert _store_size(store_dir) <= 2 * live_size
+    data = read_store(store_dir)
+    _assert_equal(data[("Austria", "st")], _results(10, "2020-01-22", 9.0))
+    _assert_equal(data[("Italy", "st")], italy)
+
+
+def test_compact_store(tmp_path):
+    store_dir = str(tmp_path / "store")
+    austria = _results(10, "2020-01-22", 1.0)
+    append_to_store(store_dir, "Austria", "st", _results(10, "2020-01-22", 0.0))
+    append_to_store(store_dir, "Austria", "st", austria)
+    before = read_store(store_dir)
+    size = _store_size(store_dir)
+
+    compact_store(store_dir)
+
+    assert _store_size(store_dir) < size
+    _assert_equal(read_store(store_dir)[("Austria", "st")], austria)
+    # arrays mapped before the compaction stay readable
+    _assert_equal(before[("Austria", "st")], austria)
+    # the compacted store can be appended to
+    append_to_store(store_dir, "Italy", "st", austria)
+    _assert_equal(read_store(store_dir)[("Italy", "st")], austria)
@@ -0,0 +1,61 @@
+import shutil
+
+import numpy as np
+import pytest
+
+from EffDI.benchmark import generate_series
+from EffDI.computation import load_data
+from EffDI.compute import compute, get_results_dir
+from EffDI.sweep import sweep
+
+COUNTRIES = ["Austria", "Korea, South"]
+
+
+def _write_data(filename, n_days):
+    dates = np.datetime64("2020-01-22") + np.arange(n_days)
+    header = ["Province/State", "Country/Region", "Lat", "Long"] + [
+        "{}/{}/{}".format(d.month, d.day, d.year % 100) for d in dates.tolist()
+    ]
+    with open(filename, "w") as f:
+        f.write(",".join(header) + "\n")
+        for k, country in enumerate(COUNTRIES):
+            series = generate_series(n_days=n_days, level=200, rng=k)
+            row = ["", '"{}"'.format(country), "0", "0"] + ["%d" % v for v in series]
+            f.write(",".join(row) + "\n")
+
+
+@pytest.mark.parametrize("crn", [False, True])
+def test_sweep_matches_compute(tmp_path, monkeypatch, crn):
+    monkeypatch.chdir(tmp_path)
+    _write_data("data.csv", 80)
+    params = {"k_samp": 10, "n": 50, "seed": 5, "crn": crn}
+
+    index = sweep(
+        data_file="data.csv",
+        fwd_weights="delta",
+        countries=COUNTRIES,
+        tau=[[6, 7], [5, 8]],
+        mode=["st"],
+        distribution=["gamma", "NB"],
+        **params
+    )
+    assert len(index["combinations"]) == 4
+    for combination in index["combinations"]:
+        parameters = combination["parameters"]
+        compute(
+            data_file="data.csv",
+            inv_weights="gamma",
+            fwd_weights="delta",
+            countries=COUNTRIES,
+            mode=parameters["mode"],
+            tau=parameters["tau"],
+            distribution=parameters["distribution"],
+            **params
+        )
+        for country in COUNTRIES:
+            expected = load_data(get_results_dir(country, parameters["mode"]))
+            results = load_data(combination["results"][country])
+            assert sorted(results) == sorted(expected)
+            for key in expected:
+                np.testing.assert_array_equal(results[key], expected[key])
+        shutil.rmtree("results")
@@ -0,0 +1,39 @@
+import numpy as np
+import pytest
+
+from EffDI.pre_compute_weights import (
+    get_weights,
+    read_weights,
+    save_weights,
+    save_weights_csv,
+)
+
+
+@pytest.mark.parametrize("kind, distribution", [("inv", "gamma"), ("fwd", "delta")])
+def test_weights_round_trip(tmp_path, kind, distribution):
+    weights, window_left, window_right = get_weights(kind, distribution)
+    for filename, save in [
+        (str(tmp_path / "weights.npz"), save_weights),
+        (str(tmp_path / "weights.csv"), save_weights_csv),
+    ]:
+        save(filename, kind, distribution)
+        read, read_left, read_right = read_weights(filename)
+        np.testing.assert_allclose(read, weights, rtol=1e-15)
+        assert (read_left, read_right) == (window_left, window_right)
+
+
+def test_weights_parameters(tmp_path):
+    filename = str(tmp_path / "weights.npz")
+    save_weights(filename, "inv", "gamma", mean=4.0, std=2.0)
+    read, _, _ = read_weights(filename, "inv")
+    expected, _, _ = get_weights("inv", "gamma", mean=4.0, std=2.0)
+
+    np.testing.assert_array_equal(read, expected)
+    assert not np.allclose(read, get_weights("inv", "gamma")[0])
+
+
+def test_weights_kind_is_checked(tmp_path):
+    filename = str(tmp_path / "weights.npz")
+    save_weights(filename, "inv", "gamma")
+    with pytest.raises(ValueError):
+        read_weights(filename, "fwd")